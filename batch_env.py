@@ -0,0 +1,132 @@
+import numpy as np
+from pacman_env import LEVEL, ACTIONS, TILE_PENALTIES, TERMINAL_TILES
+from levels import LevelInfo
+from state_encoder import StateEncoder
+
+# Tile codes used in the batched level arrays. The player is tracked by
+# position only, so its start cell is stored as empty.
+TILE_CODES = {' ': 0, '.': 1, '*': 2, 'G': 3, 'E': 4, 'X': 5, 'P': 0}
+EMPTY = TILE_CODES[' ']
+WALL = TILE_CODES['X']
+
+# Indexed by tile code. Bumping into a wall costs 1, like PacManEnv.step.
+REWARDS = np.array([TILE_PENALTIES[' '], TILE_PENALTIES['.'], TILE_PENALTIES['*'],
+                    TILE_PENALTIES['G'], TILE_PENALTIES['E'], 1], dtype=np.int64)
+TERMINAL = np.array([tile in TERMINAL_TILES for tile in (' ', '.', '*', 'G', 'E', 'X')])
+
+ACTION_DX = np.array([dx for dx, _ in ACTIONS.values()], dtype=np.int64)
+ACTION_DY = np.array([dy for _, dy in ACTIONS.values()], dtype=np.int64)
+
+
+# N copies of one level stepped at once. Every array has the batch as its
+# first axis; the rules match PacManEnv.step and the state keys match the
+# ones PacManEnv produces (so a TDAgent's V can be shared between both).
+class BatchPacManEnv:
+    def __init__(self, num_envs, level=LEVEL, seed=None):
+        self.num_envs = num_envs
+        self.height = len(level)
+        self.width = len(level[0])
+        info = LevelInfo(level)
+        self.encoder = StateEncoder(level, ACTIONS, TILE_PENALTIES, TERMINAL_TILES, info)
+        self.num_cells = self.encoder.num_cells
+        if (1 << len(self.encoder.collectible_cells)) * self.num_cells >= 1 << 63:
+            raise ValueError("level has too many collectibles for 64-bit batched state keys")
+        self.rng = np.random.default_rng(seed)
+
+        self.initial_tiles = np.array([[TILE_CODES[tile] for tile in row] for row in level], dtype=np.int8)
+        self.bit_of_cell = np.zeros((self.height, self.width), dtype=np.int64)
+        for bit, (x, y) in enumerate(self.encoder.collectible_cells):
+            self.bit_of_cell[y, x] = 1 << bit
+        self.start_pos = info.start
+        self.initial_mask = self.encoder.mask_from_level(level)
+
+        self.lanes = np.arange(num_envs)
+        self.tiles = np.empty((num_envs, self.height, self.width), dtype=np.int8)
+        self.xs = np.empty(num_envs, dtype=np.int64)
+        self.ys = np.empty(num_envs, dtype=np.int64)
+        self.masks = np.empty(num_envs, dtype=np.int64)
+        self.penalties = np.empty(num_envs, dtype=np.int64)
+        self.steps = np.empty(num_envs, dtype=np.int64)
+        self.running = np.empty(num_envs, dtype=bool)
+        self.reset()
+
+    def reset(self, lanes=None):
+        # Resets all lanes, or only those selected by a boolean mask
+        if lanes is None:
+            lanes = np.ones(self.num_envs, dtype=bool)
+        self.tiles[lanes] = self.initial_tiles
+        self.xs[lanes] = self.start_pos[0]
+        self.ys[lanes] = self.start_pos[1]
+        self.masks[lanes] = self.initial_mask
+        self.penalties[lanes] = 0
+        self.steps[lanes] = 0
+        self.running[lanes] = True
+
+    def state_keys(self):
+        return self.masks * self.num_cells + self.ys * self.width + self.xs
+
+    def targets(self, actions):
+        # Target cells for the given action indices plus whether they are blocked
+        shape = (-1,) + (1,) * (np.ndim(actions) - 1)
+        nx = self.xs.reshape(shape) + ACTION_DX[actions]
+        ny = self.ys.reshape(shape) + ACTION_DY[actions]
+        inside = (nx >= 0) & (nx < self.width) & (ny >= 0) & (ny < self.height)
+        nx = np.clip(nx, 0, self.width - 1)
+        ny = np.clip(ny, 0, self.height - 1)
+        codes = self.tiles[self.lanes.reshape(shape), ny, nx]
+        blocked = ~inside | (codes == WALL)
+        return nx, ny, codes, blocked
+
+    def step(self, actions):
+        # Applies one action index per lane. Finished lanes are left untouched
+        # and get reward 0. Returns (rewards, terminal) arrays.
+        nx, ny, codes, blocked = self.targets(actions)
+        moving = self.running & ~blocked
+        rewards = np.where(blocked, 1, REWARDS[codes])
+        rewards[~self.running] = 0
+        terminal = moving & TERMINAL[codes]
+
+        lanes = self.lanes[moving]
+        nx = nx[moving]
+        ny = ny[moving]
+        self.tiles[lanes, ny, nx] = EMPTY
+        self.masks[lanes] &= ~self.bit_of_cell[ny, nx]
+        self.xs[lanes] = nx
+        self.ys[lanes] = ny
+
+        self.penalties += rewards
+        self.steps += self.running
+        self.running &= ~terminal
+        return rewards, terminal
+
+    def successors(self):
+        # (next_keys, rewards, terminal), each of shape (num_envs, 4), for
+        # every action in ACTIONS order. Mirrors StateEncoder.successors.
+        actions = np.broadcast_to(np.arange(len(ACTIONS)), (self.num_envs, len(ACTIONS)))
+        nx, ny, codes, blocked = self.targets(actions)
+        masks = self.masks[:, None] & ~self.bit_of_cell[ny, nx]
+        next_keys = masks * self.num_cells + ny * self.width + nx
+        current_keys = self.state_keys()[:, None]
+        next_keys = np.where(blocked, current_keys, next_keys)
+        rewards = np.where(blocked, 1, REWARDS[codes])
+        terminal = ~blocked & TERMINAL[codes]
+        return next_keys, rewards, terminal
+
+
+def train_batch(agent, episodes, num_envs=1024, level=LEVEL, max_steps=10000, seed=None):
+    # Runs episodes on num_envs lanes at once until `episodes` have finished.
+    # Returns the penalties of the finished episodes in completion order.
+    env = BatchPacManEnv(num_envs, level, seed)
+    penalties = []
+    while len(penalties) < episodes:
+        old_keys = env.state_keys()
+        active = env.running.copy()
+        actions = agent.choose_actions(env)
+        rewards, _ = env.step(actions)
+        agent.update_batch(old_keys, rewards, env.state_keys(), active)
+
+        done = ~env.running | (env.steps >= max_steps)
+        if done.any():
+            penalties.extend(env.penalties[done].tolist())
+            env.reset(done)
+    return penalties[:episodes]
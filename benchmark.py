@@ -0,0 +1,242 @@
+import argparse
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from pacman_env import PacManEnv, ACTIONS, LEVEL
+from td_agent import TDAgent
+from train import run_episode, ACTION_NAMES
+from levels import generate_level
+
+# Seeded micro benchmarks of the agent's hot loop. Results are written as
+# JSON and can be compared against a saved baseline:
+#
+#   python benchmark.py --output baseline.json
+#   python benchmark.py --compare baseline.json
+#
+# Every metric is listed here with whether higher values are better.
+METRICS = {
+    "env_steps_per_second": True,
+    "zobrist_env_steps_per_second": True,
+    "get_state_ns": False,
+    "choose_action_us": False,
+    "updates_per_second": True,
+    "v_bytes_per_state": False,
+    "episode_ms": False,
+    "worker_startup_ms": False,
+}
+
+# What a headless worker imports; the UI module must not pull in pygame
+WORKER_IMPORTS = "import pacman_game, train, sweep; import sys; sys.exit('pygame' in sys.modules)"
+
+DEFAULT_TOLERANCE = 0.2
+REPEATS = 3
+
+
+def tiled_level(level, times):
+    # A wider maze made of `times` copies of the level side by side, with the
+    # player only in the first copy and the exit only in the last one
+    rows = []
+    for row in level:
+        tiled = []
+        for i in range(times):
+            for tile in row:
+                if (tile == 'P' and i > 0) or (tile == 'E' and i < times - 1):
+                    tile = '.'
+                tiled.append(tile)
+        rows.append(tiled)
+    return rows
+
+
+def best_time(function, repeats=REPEATS):
+    # Fastest of a few runs, which is the least noisy estimate
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def random_walk_states(level, count, seed):
+    # Environments positioned at `count` states along seeded random episodes
+    rng = random.Random(seed)
+    actions = list(ACTIONS)
+    envs = []
+    env = PacManEnv(level)
+    while len(envs) < count:
+        if not env.running:
+            env.reset()
+        envs.append((env.player_pos, [row[:] for row in env.level], env.collectible_mask, env.state_key))
+        env.step(rng.choice(actions))
+    return envs
+
+
+def restore(env, snapshot):
+    env.player_pos, level, env.collectible_mask, env.state_key = snapshot
+    env.level = [row[:] for row in level]
+    env.running = True
+
+
+def trained_agent(level, episodes, seed):
+    random.seed(seed)
+    agent = TDAgent()
+    env = PacManEnv(level)
+    for _ in range(episodes):
+        run_episode(env, agent)
+    return agent
+
+
+def bench_env_steps(level, steps, seed, hashing="exact"):
+    rng = random.Random(seed)
+    actions = [rng.choice(list(ACTIONS)) for _ in range(steps)]
+    env = PacManEnv(level, hashing)
+
+    def run():
+        env.reset()
+        for action in actions:
+            if not env.running:
+                env.reset()
+            env.step(action)
+    return steps / best_time(run)
+
+
+def bench_get_state(level, calls):
+    env = PacManEnv(level)
+    agent = TDAgent()
+
+    def run():
+        for _ in range(calls):
+            agent.get_state(env)
+    return best_time(run) / calls * 1e9
+
+
+def bench_choose_action(level, agent, calls, seed):
+    envs = []
+    for snapshot in random_walk_states(level, calls, seed):
+        env = PacManEnv(level)
+        restore(env, snapshot)
+        envs.append(env)
+
+    def run():
+        random.seed(seed)
+        for env in envs:
+            agent.choose_action(env, ACTION_NAMES)
+    return best_time(run) / calls * 1e6
+
+
+def bench_updates(level, agent, updates, seed):
+    rng = random.Random(seed)
+    keys = list(agent.V.keys()) or [0]
+    transitions = [(rng.choice(keys), rng.choice((-1, 1, -10)), rng.choice(keys)) for _ in range(updates)]
+
+    def run():
+        for old_state, reward, new_state in transitions:
+            agent.update(old_state, reward, new_state)
+    return updates / best_time(run)
+
+
+def bench_v_memory(agent):
+    # Deep size of V: the dict itself plus its keys and values
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    copy = type(agent.V)(float)
+    for key, value in agent.V.items():
+        copy[key + 0] = value + 0.0
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / max(len(copy), 1)
+
+
+def bench_episode(level, agent, episodes, seed):
+    env = PacManEnv(level)
+    random.seed(seed)
+    start = time.perf_counter()
+    for _ in range(episodes):
+        run_episode(env, agent)
+    return (time.perf_counter() - start) / episodes * 1e3
+
+
+def bench_worker_startup():
+    # Wall time of a fresh interpreter importing the training and UI modules
+    def run():
+        if subprocess.run([sys.executable, "-c", WORKER_IMPORTS]).returncode != 0:
+            raise RuntimeError("importing pacman_game in a headless worker imported pygame")
+    return best_time(run) * 1e3
+
+
+def run_benchmarks(levels, seed=0, scale=1.0):
+    results = {"startup": {"worker_startup_ms": bench_worker_startup()}}
+    for name, level in levels.items():
+        agent = trained_agent(level, int(200 * scale), seed)
+        results[name] = {
+            "env_steps_per_second": bench_env_steps(level, int(100000 * scale), seed),
+            "zobrist_env_steps_per_second": bench_env_steps(level, int(100000 * scale), seed, "zobrist"),
+            "get_state_ns": bench_get_state(level, int(200000 * scale)),
+            "choose_action_us": bench_choose_action(level, agent, int(20000 * scale), seed),
+            "updates_per_second": bench_updates(level, agent, int(100000 * scale), seed),
+            "v_bytes_per_state": bench_v_memory(agent),
+            "episode_ms": bench_episode(level, agent, int(100 * scale), seed),
+            "v_states": len(agent.V),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Returns a list of human-readable regressions
+    regressions = []
+    for name, metrics in results.items():
+        for metric, higher_is_better in METRICS.items():
+            old = baseline.get(name, {}).get(metric)
+            new = metrics.get(metric)
+            if old is None or new is None or old == 0:
+                continue
+            change = (new - old) / old
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f"{name}.{metric}: {old:.4g} -> {new:.4g} ({change:+.1%})")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark environment stepping, action selection and TD updates.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for the number of iterations")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--compare", default=None, help="baseline JSON file to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="relative change that counts as a regression")
+    args = parser.parse_args()
+
+    levels = {
+        "level": LEVEL,
+        "level_x4": tiled_level(LEVEL, 4),
+        "maze_32x32": generate_level(32, 32, seed=args.seed),
+        "maze_64x64": generate_level(64, 64, seed=args.seed),
+    }
+    report = {
+        "seed": args.seed,
+        "scale": args.scale,
+        "python": platform.python_version(),
+        "results": run_benchmarks(levels, args.seed, args.scale),
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report["results"], baseline["results"], args.tolerance)
+        if regressions:
+            print("Regressions against", args.compare)
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("No regressions against", args.compare)
@@ -0,0 +1,124 @@
+import argparse
+import json
+import random
+import time
+from pacman_env import PacManEnv, LEVEL, TILE_PENALTIES
+from td_agent import TDAgent
+from train import run_episode, DEFAULT_MAX_STEPS
+from levels import LevelInfo, generate_level, walk_distances
+from metrics import RollingStats
+
+# Convergence benchmark: how many episodes and how much wall-clock time TD(0)
+# and TD(λ) need until the average penalty of the last `window` episodes
+# reaches a target. Runs are seeded, so both modes see the same levels and
+# the same random number stream.
+#
+#   python convergence.py --lambdas 0,0.8 --window 100
+#
+# By default the target of a level is the penalty of walking a shortest path
+# straight to the exit, i.e. the agent has learned at least to leave the maze
+# without running into a ghost. The solver only scales to LEVEL, so this is
+# the baseline that can be computed for large generated mazes as well;
+# --slack loosens it. Runs that never reach the target report episodes as
+# null together with their final rolling average.
+DEFAULT_LAMBDAS = [0.0, 0.8]
+
+
+def exit_path_penalty(level):
+    # Penalty of one shortest path from the start to the nearest exit that
+    # avoids walls and ghosts
+    info = LevelInfo(level)
+    distance = walk_distances(level, info.start, blocked={'X', 'G'})
+    reachable = [exit for exit in info.exits if exit in distance]
+    if not reachable:
+        raise ValueError("every path to the exit passes a ghost")
+    x, y = min(reachable, key=distance.get)
+    penalty = 0
+    while (x, y) != info.start:
+        tile = level[y][x]
+        penalty += TILE_PENALTIES[tile]
+        x, y = next(cell for cell in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1))
+                    if distance.get(cell) == distance[(x, y)] - 1)
+    return penalty
+
+
+def episodes_to_target(penalties, target, window, stats=None):
+    # First episode (1-based) after which the average of the last `window`
+    # penalties is <= target, or None. penalties may be a generator, it is
+    # only consumed up to that episode. `stats` receives every penalty read.
+    stats = stats if stats is not None else RollingStats(window)
+    for episode, penalty in enumerate(penalties, 1):
+        stats.append(penalty)
+        if episode >= window and stats.mean <= target:
+            return episode
+    return None
+
+
+def train_to_target(level, trace_decay, target, window, max_episodes, seed, max_steps=DEFAULT_MAX_STEPS):
+    # Returns the first episode whose rolling average is <= target (None if
+    # it was not reached within max_episodes), the seconds it took and the
+    # rolling average at that point
+    random.seed(seed)
+    agent = TDAgent(trace_decay=trace_decay)
+    env = PacManEnv(level)
+    stats = RollingStats(window)
+    start = time.perf_counter()
+    penalties = (run_episode(env, agent, max_steps)[0] for _ in range(max_episodes))
+    episode = episodes_to_target(penalties, target, window, stats)
+    return episode, time.perf_counter() - start, stats.mean
+
+
+def run_convergence(levels, lambdas, window, max_episodes, seed, max_steps=DEFAULT_MAX_STEPS, targets=None, slack=0):
+    results = {}
+    for name, level in levels.items():
+        target = targets.get(name) if targets else None
+        if target is None:
+            target = exit_path_penalty(level) + slack
+        runs = {}
+        for trace_decay in lambdas:
+            episodes, seconds, average = train_to_target(level, trace_decay, target, window, max_episodes, seed,
+                                                         max_steps)
+            runs[f"lambda_{trace_decay:g}"] = {"episodes": episodes, "seconds": seconds, "average": average}
+        results[name] = {"target": target, "runs": runs}
+    return results
+
+
+def float_list(text):
+    return [float(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare how fast TD(0) and TD(lambda) reach a target penalty.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lambdas", type=float_list, default=DEFAULT_LAMBDAS,
+                        help="comma separated trace decays, 0 is TD(0)")
+    parser.add_argument("--window", type=int, default=100, help="episodes in the rolling average")
+    parser.add_argument("--max-episodes", type=int, default=20000)
+    parser.add_argument("--max-steps", type=int, default=DEFAULT_MAX_STEPS)
+    parser.add_argument("--target", type=float, default=None,
+                        help="target average penalty for every level instead of the exit path penalty")
+    parser.add_argument("--slack", type=float, default=0,
+                        help="points added to the exit path penalty to get the default target")
+    parser.add_argument("--sizes", type=lambda text: [int(size) for size in text.split(",")], default=[16, 32],
+                        help="comma separated sizes of generated square mazes")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    args = parser.parse_args()
+    if any(not 0 <= trace_decay < 1 for trace_decay in args.lambdas):
+        parser.error("--lambdas must be >= 0 and below 1 (the discount factor is 1)")
+
+    levels = {"level": LEVEL}
+    for size in args.sizes:
+        levels[f"maze_{size}x{size}"] = generate_level(size, size, seed=args.seed)
+    targets = {name: args.target for name in levels} if args.target is not None else None
+    report = {
+        "seed": args.seed,
+        "window": args.window,
+        "max_episodes": args.max_episodes,
+        "results": run_convergence(levels, args.lambdas, args.window, args.max_episodes, args.seed,
+                                   args.max_steps, targets, args.slack),
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
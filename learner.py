@@ -0,0 +1,110 @@
+import threading
+import time
+from pacman_env import PacManEnv, LEVEL
+from train import ACTION_NAMES, DEFAULT_MAX_STEPS
+from metrics import RollingStats
+
+# Number of steps taken per lock acquisition. The UI only needs the lock for
+# a snapshot once per frame, so larger chunks mean less contention.
+STEPS_PER_CHUNK = 256
+
+
+# Runs the agent on its own environment in a worker thread, as fast as it can.
+# The UI never steps the agent itself: it takes snapshots of the learner's
+# environment at display FPS and controls it through pause/step requests.
+class BackgroundLearner(threading.Thread):
+    def __init__(self, agent, level=LEVEL, max_steps=DEFAULT_MAX_STEPS, on_episode_end=None, scores=None):
+        super().__init__(daemon=True)
+        self.agent = agent
+        self.env = PacManEnv(level)
+        self.max_steps = max_steps
+        # Called from the learner thread as on_episode_end(round_num, penalty, steps)
+        self.on_episode_end = on_episode_end
+        self.lock = threading.Lock()
+        self.wake_up = threading.Condition(self.lock)
+        self.is_paused = True
+        self.pending_steps = 0
+        self.is_stopped = False
+
+        self.round_num = 1
+        self.episode_steps = 0
+        self.total_steps = 0
+        self.last_scores = scores if scores is not None else RollingStats(100)
+        self.max_penalty = None
+        self.steps_per_second = 0.0
+
+    def set_paused(self, is_paused):
+        with self.lock:
+            self.is_paused = is_paused
+            self.wake_up.notify()
+
+    def request_step(self):
+        with self.lock:
+            self.pending_steps += 1
+            self.wake_up.notify()
+
+    def stop(self):
+        with self.lock:
+            self.is_stopped = True
+            self.wake_up.notify()
+
+    def run(self):
+        rate_start = time.perf_counter()
+        rate_steps = 0
+        while True:
+            with self.lock:
+                while self.is_paused and not self.pending_steps and not self.is_stopped:
+                    self.wake_up.wait()
+                    rate_start = time.perf_counter()
+                    rate_steps = 0
+                if self.is_stopped:
+                    return
+                if self.is_paused:
+                    steps = 1
+                    self.pending_steps -= 1
+                else:
+                    steps = STEPS_PER_CHUNK
+                for _ in range(steps):
+                    self.step()
+                rate_steps += steps
+            # Give the UI thread a chance to take the GIL between chunks
+            time.sleep(0)
+
+            elapsed = time.perf_counter() - rate_start
+            if elapsed >= 0.5:
+                self.steps_per_second = rate_steps / elapsed
+                rate_start = time.perf_counter()
+                rate_steps = 0
+
+    def step(self):
+        # One TD(0) step, called with the lock held
+        agent = self.agent
+        env = self.env
+        old_state = agent.get_state(env)
+        action = agent.choose_action(env, ACTION_NAMES)
+        reward, _, _ = env.step(action)
+        agent.update(old_state, reward, agent.get_state(env))
+        self.episode_steps += 1
+        self.total_steps += 1
+        if not env.running or self.episode_steps >= self.max_steps:
+            if self.max_penalty is None or env.penalty < self.max_penalty:
+                self.max_penalty = env.penalty
+            self.last_scores.append(env.penalty)
+            if self.on_episode_end is not None:
+                self.on_episode_end(self.round_num, env.penalty, self.episode_steps)
+            self.round_num += 1
+            self.episode_steps = 0
+            agent.end_episode(env.penalty)
+            env.reset()
+
+    def snapshot_into(self, env):
+        # Copies the learner's current episode into another environment (the
+        # one the UI draws) and returns the value estimate of that state
+        with self.lock:
+            env.level = [row[:] for row in self.env.level]
+            env.player_pos = self.env.player_pos
+            env.penalty = self.env.penalty
+            env.running = self.env.running
+            env.collectible_mask = self.env.collectible_mask
+            env.state_key = self.env.state_key
+            return self.agent.V.get(self.env.state_key, 0.0)
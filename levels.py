@@ -0,0 +1,208 @@
+import random
+from collections import deque
+
+# Level files use the same characters as LEVEL, one row per line:
+#
+#   ............
+#   .XXXXX.X.XX.
+#   .XG..X.X.*X.
+#
+# Trailing spaces are significant (' ' is an empty cell), so rows shorter
+# than the widest row are padded with empty cells.
+VALID_TILES = {'.', '*', 'G', 'E', ' ', 'X', 'P'}
+COLLECTIBLE_TILES = {'.', '*', 'G'}
+
+
+def parse_level(text):
+    lines = [line.rstrip("\r\n") for line in text.split("\n")]
+    # Only truly empty lines are dropped, a line of spaces is a row of
+    # empty cells
+    while lines and lines[-1] == "":
+        lines.pop()
+    width = max((len(line) for line in lines), default=0)
+    level = [list(line.ljust(width)) for line in lines]
+    validate_level(level)
+    return level
+
+
+def load_level(path):
+    with open(path) as f:
+        return parse_level(f.read())
+
+
+def save_level(level, path):
+    with open(path, "w") as f:
+        f.write(format_level(level))
+
+
+def format_level(level):
+    return "".join("".join(row) + "\n" for row in level)
+
+
+def validate_level(level):
+    if not level or not level[0]:
+        raise ValueError("level is empty")
+    width = len(level[0])
+    starts = []
+    exits = []
+    for y, row in enumerate(level):
+        if len(row) != width:
+            raise ValueError(f"row {y} has {len(row)} tiles, expected {width}")
+        for x, tile in enumerate(row):
+            if tile not in VALID_TILES:
+                raise ValueError(f"unknown tile {tile!r} at ({x}, {y})")
+            if tile == 'P':
+                starts.append((x, y))
+            elif tile == 'E':
+                exits.append((x, y))
+    if len(starts) != 1:
+        raise ValueError(f"level needs exactly one player start 'P', found {len(starts)}")
+    if not exits:
+        raise ValueError("level needs at least one exit 'E'")
+    distance = walk_distances(level, starts[0], blocked={'X'})
+    if not any(exit in distance for exit in exits):
+        raise ValueError("no exit can be reached from the player start")
+
+
+def walk_distances(level, start, blocked):
+    # Breadth-first distances from start over cells whose tile is not blocked
+    height = len(level)
+    width = len(level[0])
+    distance = {start: 0}
+    queue = deque([start])
+    while queue:
+        x, y = queue.popleft()
+        for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+            if 0 <= nx < width and 0 <= ny < height and (nx, ny) not in distance and level[ny][nx] not in blocked:
+                distance[(nx, ny)] = distance[(x, y)] + 1
+                queue.append((nx, ny))
+    return distance
+
+
+# Per-level data that never changes during an episode, computed once when an
+# environment is created instead of on every reset.
+class LevelInfo:
+    def __init__(self, level):
+        validate_level(level)
+        self.height = len(level)
+        self.width = len(level[0])
+        self.walls = [[tile == 'X' for tile in row] for row in level]
+        self.exits = []
+        self.collectible_cells = []
+        for y, row in enumerate(level):
+            for x, tile in enumerate(row):
+                if tile == 'P':
+                    self.start = (x, y)
+                elif tile == 'E':
+                    self.exits.append((x, y))
+                elif tile in COLLECTIBLE_TILES:
+                    self.collectible_cells.append((x, y))
+
+
+def generate_level(width, height, seed=None, collectible_density=0.8, star_density=0.02,
+                   ghost_density=0.02, loop_density=0.1):
+    # Seeded random maze: a spanning tree of corridors carved with a depth
+    # first search, plus some removed walls to create loops. Open cells get
+    # dots, stars and ghosts with the given densities. The player starts in
+    # the top-left corner and the exit is the open cell farthest to the
+    # bottom-right. Ghosts are never placed on the shortest path to the exit.
+    if width < 3 or height < 3:
+        raise ValueError("levels must be at least 3x3")
+    rng = random.Random(seed)
+    level = [['X'] * width for _ in range(height)]
+
+    # Corridor cells sit on even coordinates, walls in between
+    level[0][0] = ' '
+    stack = [(0, 0)]
+    while stack:
+        x, y = stack[-1]
+        neighbours = [(x + dx, y + dy, dx, dy) for dx, dy in ((2, 0), (-2, 0), (0, 2), (0, -2))
+                      if 0 <= x + dx < width and 0 <= y + dy < height and level[y + dy][x + dx] == 'X']
+        if not neighbours:
+            stack.pop()
+            continue
+        nx, ny, dx, dy = rng.choice(neighbours)
+        level[y + dy // 2][x + dx // 2] = ' '
+        level[ny][nx] = ' '
+        stack.append((nx, ny))
+
+    # Knock out walls between two corridors to add loops
+    for y in range(height):
+        for x in range(width):
+            if level[y][x] != 'X' or rng.random() >= loop_density:
+                continue
+            horizontal = 0 < x < width - 1 and level[y][x - 1] == ' ' and level[y][x + 1] == ' '
+            vertical = 0 < y < height - 1 and level[y - 1][x] == ' ' and level[y + 1][x] == ' '
+            if horizontal != vertical:
+                level[y][x] = ' '
+
+    start = (0, 0)
+    open_cells = [(x, y) for y in range(height) for x in range(width) if level[y][x] == ' ']
+    exit_x, exit_y = max(open_cells, key=lambda cell: (cell[0] + cell[1], cell[1]))
+    level[0][0] = 'P'
+    level[exit_y][exit_x] = 'E'
+
+    # Cells on one shortest path from the start to the exit stay ghost free
+    distance = walk_distances(level, start, blocked={'X'})
+    protected = {(exit_x, exit_y)}
+    x, y = exit_x, exit_y
+    while (x, y) != start:
+        x, y = next(cell for cell in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1))
+                    if distance.get(cell) == distance[(x, y)] - 1)
+        protected.add((x, y))
+
+    for x, y in open_cells:
+        if (x, y) == start or (x, y) == (exit_x, exit_y):
+            continue
+        roll = rng.random()
+        if roll < ghost_density and (x, y) not in protected:
+            level[y][x] = 'G'
+        elif roll < ghost_density + star_density:
+            level[y][x] = '*'
+        elif roll < ghost_density + star_density + collectible_density:
+            level[y][x] = '.'
+    validate_level(level)
+    return level
+
+
+def size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def add_level_arguments(parser):
+    # Shared by the command line tools: --level FILE or --generate WxH
+    parser.add_argument("--level", default=None, help="level file to play instead of the built-in LEVEL")
+    parser.add_argument("--generate", type=size, default=None, metavar="WxH",
+                        help="play a generated maze of this size instead of the built-in LEVEL")
+    parser.add_argument("--level-seed", type=int, default=0, help="seed for --generate")
+
+
+def level_from_args(args, default):
+    if args.level:
+        return load_level(args.level)
+    if args.generate:
+        return generate_level(*args.generate, seed=args.level_seed)
+    return default
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate a random maze level file.")
+    parser.add_argument("width", type=int)
+    parser.add_argument("height", type=int)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--collectible-density", type=float, default=0.8)
+    parser.add_argument("--star-density", type=float, default=0.02)
+    parser.add_argument("--ghost-density", type=float, default=0.02)
+    parser.add_argument("--loop-density", type=float, default=0.1)
+    parser.add_argument("--output", default=None, help="level file to write, prints the level if omitted")
+    args = parser.parse_args()
+
+    level = generate_level(args.width, args.height, args.seed, args.collectible_density,
+                           args.star_density, args.ghost_density, args.loop_density)
+    if args.output:
+        save_level(level, args.output)
+    else:
+        print(format_level(level), end="")
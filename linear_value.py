@@ -0,0 +1,91 @@
+import numpy as np
+from levels import walk_distances
+from pacman_env import TERMINAL_TILES
+
+# Linear value function approximation for levels whose state space is too
+# big for a table. A state is described by a few cheap features and its value
+# is the dot product with a NumPy weight vector:
+#
+#   remaining collectibles          fraction still on the board
+#   distance to the nearest ghost   walking distance, scaled to [0, 1]
+#   distance to the exit            walking distance, scaled to [0, 1]
+#   cell                            one weight per cell (one-hot position)
+#
+# There is no bias or x/y feature: the one-hot cell already spans them, and
+# a weight shared by every state moves all values together, which on LEVEL
+# inflates them until running into a ghost looks cheapest.
+#
+# The object behaves like the agent's value table: TDAgent.update assigns
+# V[s] + alpha * delta, which here becomes the semi-gradient TD(0) step
+# w += alpha * delta * features(s). Memory is one weight per feature however
+# many states are visited. Keys have to be exact StateEncoder keys because
+# the features are read back from them. States on a terminal tile are worth
+# 0, like the table's never-written terminal keys, instead of taking whatever
+# value the weights generalise to.
+NUM_DENSE_FEATURES = 3
+
+
+class LinearValueFunction:
+    def __init__(self, env):
+        if env.hashing != "exact":
+            raise ValueError("LinearValueFunction needs exact state keys, Zobrist keys cannot be decoded")
+        self.encoder = env.encoder
+        level = env.initial_level
+        width, height = env.width, env.height
+        self.num_cells = self.encoder.num_cells
+        self.num_collectibles = max(len(self.encoder.collectible_cells), 1)
+        self.weights = np.zeros(NUM_DENSE_FEATURES + self.num_cells)
+
+        # Walking distances can only change when a ghost is eaten, and that
+        # ends the episode, so both distances are fixed per cell
+        ghosts = [(x, y) for y, row in enumerate(level) for x, tile in enumerate(row) if tile == 'G']
+        exits = [(x, y) for y, row in enumerate(level) for x, tile in enumerate(row) if tile == 'E']
+        unreachable = width * height
+        ghost_distance = self.nearest_distances(level, ghosts, unreachable)
+        exit_distance = self.nearest_distances(level, exits, unreachable)
+        self.terminal_cells = [level[cell // width][cell % width] in TERMINAL_TILES for cell in range(self.num_cells)]
+        self.cell_features = np.zeros((self.num_cells, NUM_DENSE_FEATURES))
+        for cell in range(self.num_cells):
+            self.cell_features[cell] = (0.0, ghost_distance[cell] / unreachable, exit_distance[cell] / unreachable)
+
+    @staticmethod
+    def nearest_distances(level, targets, unreachable):
+        # Distance from every cell to the closest target, walls block walking
+        width = len(level[0])
+        distance = [unreachable] * (width * len(level))
+        for target in targets:
+            for (x, y), d in walk_distances(level, target, blocked={'X'}).items():
+                distance[y * width + x] = min(distance[y * width + x], d)
+        return distance
+
+    def features(self, key):
+        # Dense features and the cell index of the one-hot feature
+        mask, cell = divmod(key, self.num_cells)
+        dense = self.cell_features[cell].copy()
+        dense[0] = mask.bit_count() / self.num_collectibles
+        return dense, cell
+
+    def __len__(self):
+        return len(self.weights)
+
+    def __getitem__(self, key):
+        if self.terminal_cells[key % self.num_cells]:
+            return 0.0
+        dense, cell = self.features(key)
+        return float(dense @ self.weights[:NUM_DENSE_FEATURES] + self.weights[NUM_DENSE_FEATURES + cell])
+
+    def get(self, key, default=None):
+        return self[key]
+
+    def __setitem__(self, key, value):
+        # Moves the prediction for key towards value by one gradient step
+        dense, cell = self.features(key)
+        weights = self.weights
+        step = value - float(dense @ weights[:NUM_DENSE_FEATURES] + weights[NUM_DENSE_FEATURES + cell])
+        weights[:NUM_DENSE_FEATURES] += step * dense
+        weights[NUM_DENSE_FEATURES + cell] += step
+
+    def keys(self):
+        raise TypeError("LinearValueFunction has no table to save, save its weights instead")
+
+    items = keys
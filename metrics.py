@@ -0,0 +1,100 @@
+import json
+import time
+from collections import deque
+
+# Per-episode statistics in fixed memory.
+#
+# RollingStats keeps mean, variance and minimum over the last `window`
+# values, each updated in O(1) (amortised for the minimum) per value, plus
+# the last `keep` values for display. count and best cover all values ever
+# added.
+class RollingStats:
+    def __init__(self, window, keep=None):
+        self.window = window
+        self.values = deque(maxlen=max(window, keep or 0))
+        self.count = 0
+        self.best = None
+        self.total = 0.0
+        self.total_squares = 0.0
+        # (index, value) with increasing values; the front is the window minimum
+        self.minima = deque()
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        if self.count >= self.window:
+            # values[-window] is the value leaving the window
+            old = self.values[-self.window]
+            self.total -= old
+            self.total_squares -= old * old
+        self.values.append(value)
+        self.total += value
+        self.total_squares += value * value
+        while self.minima and self.minima[-1][1] >= value:
+            self.minima.pop()
+        self.minima.append((self.count, value))
+        if self.minima[0][0] <= self.count - self.window:
+            self.minima.popleft()
+        self.count += 1
+        if self.best is None or value < self.best:
+            self.best = value
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    @property
+    def size(self):
+        return min(self.count, self.window)
+
+    @property
+    def mean(self):
+        return self.total / self.size if self.count else 0.0
+
+    @property
+    def variance(self):
+        if not self.count:
+            return 0.0
+        mean = self.mean
+        return max(self.total_squares / self.size - mean * mean, 0.0)
+
+    @property
+    def min(self):
+        return self.minima[0][1] if self.minima else None
+
+    def recent(self, n):
+        # Last n values, oldest first. list() copies the deque in one go, so
+        # this is safe while another thread appends.
+        values = list(self.values)
+        return values[-n:] if n > 0 else []
+
+
+# Streams one record per episode to a CSV or JSON lines file (chosen by the
+# file extension) through a large write buffer, so long runs produce a
+# complete learning curve without keeping it in memory.
+METRIC_FIELDS = ["round", "penalty", "steps", "elapsed", "states"]
+WRITE_BUFFER_BYTES = 1 << 20
+
+
+class MetricsWriter:
+    def __init__(self, path):
+        self.path = path
+        self.is_csv = path.endswith(".csv")
+        self.file = open(path, "w", newline="" if self.is_csv else None, buffering=WRITE_BUFFER_BYTES)
+        self.start = time.perf_counter()
+        if self.is_csv:
+            # csv pulls in re, only import it when a CSV file is written
+            import csv
+            self.writer = csv.writer(self.file)
+            self.writer.writerow(METRIC_FIELDS)
+
+    def write(self, round_num, penalty, steps, states):
+        elapsed = round(time.perf_counter() - self.start, 6)
+        if self.is_csv:
+            self.writer.writerow([round_num, penalty, steps, elapsed, states])
+        else:
+            self.file.write(json.dumps(dict(zip(METRIC_FIELDS, [round_num, penalty, steps, elapsed, states]))) + "\n")
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,142 @@
+import zlib
+from levels import LevelInfo
+from state_encoder import StateEncoder, ZobristEncoder
+
+LEVEL = [
+    ['.', '.', '.', '.', '.', '.', '.', '.', '.', '.', '.', '.'],
+    ['.', 'X', 'X', 'X', 'X', 'X', '.', 'X', '.', 'X', 'X', '.'],
+    ['.', 'X', 'G', '.', '.', 'X', '.', 'X', '.', '*', 'X', '.'],
+    ['.', 'X', '.', '.', 'P', 'X', '.', 'X', '.', '.', 'X', '.'],
+    ['.', 'X', '.', '.', 'X', 'X', 'G', 'X', '.', '.', 'X', '.'],
+    ['.', '.', '.', '.', '.', '.', '.', 'X', '.', '.', 'X', 'E'],
+]
+
+ACTIONS = {
+    'left': (-1, 0),
+    'right': (1, 0),
+    'up': (0, -1),
+    'down': (0, 1),
+}
+
+# Penalty for stepping onto a tile (walls cost 1 as well, see step)
+TILE_PENALTIES = {
+    'G': 100,   # Ghost: high penalty
+    'E': 0,     # Exit/goal: neutral
+    '*': -10,   # Collectible/star: good
+    '.': -1,    # Minor reward
+    ' ': 1,     # Empty space: small cost
+}
+
+TERMINAL_TILES = {'G', 'E'}
+
+
+# State key schemes, see StateEncoder and ZobristEncoder
+HASHING_MODES = ("exact", "zobrist")
+
+
+def level_id(level, hashing="exact"):
+    # Stable 32-bit fingerprint of a level layout, stored with saved value tables.
+    # Zobrist keys live in a different key space, so they get a different id.
+    layout_id = zlib.crc32("\n".join("".join(row) for row in level).encode())
+    if hashing == "zobrist":
+        return zlib.crc32(b"zobrist", layout_id)
+    return layout_id
+
+
+# Render-free PacMan environment: holds the level, player position and penalty
+# and applies the tile rules. Has no pygame dependency so it can be used for
+# headless training; PacManGame only draws on top of it.
+#
+# hashing="exact" keys states with StateEncoder (decodable, but the key grows
+# with the number of collectibles), hashing="zobrist" with ZobristEncoder
+# (64-bit, constant cost per step on any map size). check_keys recomputes the
+# key from the grid after every step and raises if the incremental key differs.
+class PacManEnv:
+    def __init__(self, level=LEVEL, hashing="exact", check_keys=False):
+        if hashing not in HASHING_MODES:
+            raise ValueError(f"unknown hashing mode {hashing!r}, expected one of {HASHING_MODES}")
+        self.initial_level = [row[:] for row in level]
+        # Validates the level and precomputes walls, start and collectibles
+        self.info = LevelInfo(self.initial_level)
+        self.height = self.info.height
+        self.width = self.info.width
+        self.walls = self.info.walls
+        self.hashing = hashing
+        self.check_keys = check_keys
+        if hashing == "zobrist":
+            self.encoder = ZobristEncoder(self.initial_level, ACTIONS, TILE_PENALTIES, TERMINAL_TILES, self.info)
+            self.initial_present = self.encoder.initial_present(self.initial_level)
+            self.initial_key = self.encoder.hash(self.info.start, self.initial_present)
+        else:
+            self.encoder = StateEncoder(self.initial_level, ACTIONS, TILE_PENALTIES, TERMINAL_TILES, self.info)
+            self.initial_mask = self.encoder.mask_from_level(self.initial_level)
+        self.reset()
+
+    def reset(self):
+        self.level = [row[:] for row in self.initial_level]
+        self.player_pos = self.info.start
+        # Compact state key, kept up to date incrementally in step. Exact keys
+        # track the remaining collectibles in collectible_mask, Zobrist keys
+        # in the present bytearray.
+        if self.hashing == "zobrist":
+            self.collectible_mask = None
+            self.present = self.initial_present[:]
+            self.state_key = self.initial_key
+        else:
+            self.collectible_mask = self.initial_mask
+            self.present = None
+            self.state_key = self.encoder.key(self.player_pos, self.collectible_mask)
+        self.penalty = 0
+        self.running = True
+        return self.player_pos
+
+    def successors(self):
+        # (next_key, reward, terminal) for every action, in ACTIONS order
+        if self.hashing == "zobrist":
+            return self.encoder.hash_successors(self.state_key, self.player_pos, self.present)
+        return self.encoder.successors(self.state_key)
+
+    def verify_state_key(self):
+        expected = self.encoder.encode(self.player_pos, self.level)
+        if self.state_key != expected:
+            raise RuntimeError(f"incremental state key {self.state_key} does not match "
+                               f"recomputed key {expected} at {self.player_pos}")
+
+    def can_move(self, nx, ny):
+        if not (0 <= nx < self.width and 0 <= ny < self.height):
+            return False
+        if self.walls[ny][nx]:
+            return False
+
+        return True
+
+    def step(self, action):
+        # Returns (reward, terminal, tile) where tile is what PacMan stepped on
+        # (None if the move was blocked or the episode is already over)
+        if not self.running:
+            return 0, True, None
+        dx, dy = ACTIONS[action]
+        x, y = self.player_pos
+        nx, ny = x + dx, y + dy
+        if not self.can_move(nx, ny):
+            self.penalty += 1
+            return 1, False, None
+
+        tile = self.level[ny][nx]
+        reward = TILE_PENALTIES.get(tile, 0)
+        self.penalty += reward
+        self.level[y][x] = ' '
+        self.level[ny][nx] = 'P'
+        if self.hashing == "zobrist":
+            self.state_key = self.encoder.move(self.state_key, self.present, (x, y), (nx, ny))
+            self.player_pos = (nx, ny)
+        else:
+            self.player_pos = (nx, ny)
+            self.collectible_mask = self.encoder.consume(self.collectible_mask, self.player_pos)
+            self.state_key = self.encoder.key(self.player_pos, self.collectible_mask)
+        if self.check_keys:
+            self.verify_state_key()
+        terminal = tile in TERMINAL_TILES
+        if terminal:
+            self.running = False
+        return reward, terminal, tile
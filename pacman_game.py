@@ -1,25 +1,26 @@
-import pygame
 import os
 import sys
 from td_agent import TDAgent
+from pacman_env import PacManEnv, LEVEL, level_id
+from levels import add_level_arguments, level_from_args
+from metrics import RollingStats, MetricsWriter
+import profiling
 
 agent = TDAgent()
 
+# pygame is imported when the first window is opened (load_pygame), so
+# importing this module in headless workers does not pay for the UI
+pygame = None
+
 TILE_SIZE = 64
 BORDER_THICKNESS = 120
 FPS = 60
 DEFAULT_MOVES_PER_SECOND = 1
 DEFAULT_GAMMA = 0.9
 PAUSE = 1
-LEVEL = [
-    ['.', '.', '.', '.', '.', '.', '.', '.', '.', '.', '.', '.'],
-    ['.', 'X', 'X', 'X', 'X', 'X', '.', 'X', '.', 'X', 'X', '.'],
-    ['.', 'X', 'G', '.', '.', 'X', '.', 'X', '.', '*', 'X', '.'],
-    ['.', 'X', '.', '.', 'P', 'X', '.', 'X', '.', '.', 'X', '.'],
-    ['.', 'X', '.', '.', 'X', 'X', 'G', 'X', '.', '.', 'X', '.'],
-    ['.', '.', '.', '.', '.', '.', '.', 'X', '.', '.', 'X', 'E'],
-]
-
+# The learned value table is kept here between runs
+VALUE_TABLE_PATH = "value_table.bin"
+CHECKPOINT_EVERY_ROUNDS = 50
 TILE_COLORS = {
     ' ': (0, 0, 0),
     '.': (200, 200, 200),
@@ -32,8 +33,18 @@ TILE_COLORS = {
 
 DEFAULT_TEXT_FIELD_COLOR = (70, 130, 180)
 
+PATH_COLOR = (255, 0, 0)
+
 HIGHLIGHTED_TEXT_FIELD_COLOR = (100, 160, 210)
 
+BACKGROUND_COLOR = (50, 50, 50)
+
+# The average shown above the score list is over this many rounds
+AVERAGE_WINDOW = 25
+
+# Space kept free for the buttons and their labels below the score list
+SCORES_BOTTOM_MARGIN = 140
+
 IMAGE_PATHS = {
     ' ': 'assets/empty.PNG',
     'P': 'assets/pacman.PNG',
@@ -44,18 +55,26 @@ IMAGE_PATHS = {
     'X': 'assets/wall.PNG'
 }
 
+def load_pygame():
+    global pygame
+    if pygame is None:
+        import pygame as pygame_module
+        pygame = pygame_module
+    return pygame
+
+
 class PacManGame:
     def __init__(self, level, start_maximized=False):
+        load_pygame()
         pygame.init()
-        self.level = [row[:] for row in level]
-        self.height = len(level)
-        self.width = len(level[0])
+        self.env = PacManEnv(level)
+        self.height = self.env.height
+        self.width = self.env.width
         self.gamma = str(DEFAULT_GAMMA)
-        self.penalty = 0
         self.max_penalty = None
-        self.find_player()
-        self.last_scores = []
         self.max_scores_to_show = 55
+        # Rolling average and the most recent scores, in fixed memory
+        self.last_scores = RollingStats(AVERAGE_WINDOW, keep=self.max_scores_to_show)
 
         flags = pygame.RESIZABLE
 
@@ -82,8 +101,15 @@ class PacManGame:
         self.images = self.load_images()
         self.other_pacman_orientations = self.generate_other_pacman_orientations(self.images.get("P"))
         self.is_clockwise_orientation = True
+        self.pacman_orientation = "facing_right"
+        # Caches for draw(): pre-scaled sprites, rendered text and what is
+        # currently on screen, so only changed tiles and panels are redrawn
+        self.sprite_tile_size = None
+        self.text_cache = {}
+        self.drawn_screen_size = None
+        self.drawn_y_start = None
+        self.full_redraw = True
         self.clock = pygame.time.Clock()
-        self.running = True
         self.is_paused = True
         self.resume_stop_button_text = "Start"
         self.perform_step_forward = False
@@ -91,6 +117,19 @@ class PacManGame:
         self.is_adjust_play_rate_text_field_active = False
         self.is_adjust_gamma_text_field_active = False
         self.round_num = 1
+        self.steps_per_second = None
+        self.state_value = None
+        # Cells of the agent's greedy path, drawn as a line over the tiles
+        self.path_positions = []
+        self.path_overlay = {}
+        self.overlay_positions = None
+        self.replay_requested = False
+        self.can_replay_best = True
+        # Trace viewer: step backward and switching episodes, see run_trace_viewer
+        self.can_step_backward = False
+        self.perform_step_backward = False
+        self.episode_change = 0
+        self.trace_position = None
 
     def load_images(self):
         images = {}
@@ -115,97 +154,154 @@ class PacManGame:
         
         return pacman_orientations
 
-    def find_player(self):
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.level[y][x] == 'P':
-                    self.player_pos = (x, y)
-                    return
+    # The game state lives in the headless environment, the game only renders it
+    @property
+    def level(self):
+        return self.env.level
+
+    @property
+    def player_pos(self):
+        return self.env.player_pos
+
+    @property
+    def penalty(self):
+        return self.env.penalty
+
+    @property
+    def state_key(self):
+        return self.env.state_key
+
+    @property
+    def encoder(self):
+        return self.env.encoder
+
+    def successors(self):
+        return self.env.successors()
+
+    @property
+    def running(self):
+        return self.env.running
 
     def can_move(self, nx, ny):
-        if not (0 <= nx < self.width and 0 <= ny < self.height):
-            return False
-        if self.level[ny][nx] == 'X':
-            return False
-        
-        return True
+        return self.env.can_move(nx, ny)
 
-    def move_pacman(self, dx, dy):
+    def move_pacman(self, action):
         if not self.running:
             return
-        x, y = self.player_pos
-        nx, ny = x + dx, y + dy
-        if self.can_move(nx, ny):
-            tile = self.level[ny][nx]
+        _, terminal, tile = self.env.step(action)
+        self.draw()
+        if terminal:
             if tile == 'G':
-                self.penalty += 100
-                self.level[y][x] = ' '
-                self.level[ny][nx] = 'P'
-                self.player_pos = (nx, ny)
-                self.draw()
                 print("Game over: hit a ghost! Final penalty:", self.penalty)
-                self.running = False
-                pygame.time.wait(PAUSE)
-                return
-            elif tile == '*':
-                self.penalty -= 10
-            elif tile == '.':
-                self.penalty -= 1
-            elif tile == ' ':
-                self.penalty += 1
-            elif tile == 'E':
-                self.level[y][x] = ' '
-                self.level[ny][nx] = 'P'
-                self.player_pos = (nx, ny)
-                self.draw()
+            else:
                 print("Goal reached! Final penalty:", self.penalty)
-                self.running = False
-                pygame.time.wait(PAUSE)
-                return
-
-            self.level[y][x] = ' '
-            self.level[ny][nx] = 'P'
-            self.player_pos = (nx, ny)
-            self.draw()
-            self.clock.tick(FPS)
-        else:
-            self.penalty += 1
-            self.draw()
-            self.clock.tick(FPS)
+            pygame.time.wait(PAUSE)
+            return
+        self.clock.tick(FPS)
 
     def move_left(self):
         self.is_clockwise_orientation = False
         self.change_pacman_orientation("facing_left")
-        self.move_pacman(-1, 0)
+        self.move_pacman('left')
 
     def move_right(self):
         self.is_clockwise_orientation = True
         self.change_pacman_orientation("facing_right")
-        self.move_pacman(1, 0)
+        self.move_pacman('right')
 
     def move_up(self):
         if self.is_clockwise_orientation:
             self.change_pacman_orientation("facing_up_clockwise")
         else:
             self.change_pacman_orientation("facing_up_counterclockwise")
-        self.move_pacman(0, -1)
+        self.move_pacman('up')
 
     def move_down(self):
         if self.is_clockwise_orientation:
             self.change_pacman_orientation("facing_down_clockwise")
         else:
             self.change_pacman_orientation("facing_down_counterclockwise")
-        self.move_pacman(0, 1)
+        self.move_pacman('down')
         
     def change_pacman_orientation(self, orientation):
+        self.pacman_orientation = orientation
         self.images["P"] = self.other_pacman_orientations.get(orientation)
 
-    def draw(self):
-        self.screen.fill((50, 50, 50))
-
+    def scale_sprites(self):
+        # Tile sprites are drawn with a 2px margin; scale them once per tile size
+        # instead of once per tile per frame
+        size = (self.tile_size - 4, self.tile_size - 4)
+        self.small_images = {
+            tile: pygame.transform.smoothscale(image, size) if image else None
+            for tile, image in self.images.items() if tile != 'P'
+        }
+        self.small_pacman_orientations = {
+            orientation: pygame.transform.smoothscale(image, size)
+            for orientation, image in self.other_pacman_orientations.items()
+        }
+        self.sprite_tile_size = self.tile_size
+
+    def render_text(self, text):
+        # Rendered text surfaces are cached until the text changes
+        surface = self.text_cache.get(text)
+        if surface is None:
+            if len(self.text_cache) > 1000:
+                self.text_cache.clear()
+            surface = self.font.render(text, True, (255, 255, 255))
+            self.text_cache[text] = surface
+        return surface
+
+    def draw_text(self, name, text, dirty, **position):
+        # Draws a text panel only if its text or position changed since the
+        # last frame, clearing what it covered before
+        surface = self.render_text(text)
+        rect = surface.get_rect(**position)
+        previous = self.drawn_panels.get(name)
+        if previous == (text, rect):
+            return
+        if previous is not None:
+            self.screen.fill(BACKGROUND_COLOR, previous[1])
+            dirty.append(previous[1])
+        self.screen.blit(surface, rect)
+        dirty.append(rect)
+        self.drawn_panels[name] = (text, rect)
+
+    def draw_button(self, name, rect, text, color, dirty):
+        if self.drawn_panels.get(name) == (text, rect, color):
+            return
+        pygame.draw.rect(self.screen, color, rect)
+        text_surf = self.render_text(text)
+        self.screen.blit(text_surf, text_surf.get_rect(center=rect.center))
+        dirty.append(rect)
+        self.drawn_panels[name] = (text, rect, color)
+
+    def update_path_overlay(self):
+        # For every cell on the path, the directions its line segments leave
+        # the cell in; recomputed only when a new path is set
+        if self.overlay_positions is self.path_positions:
+            return
+        self.overlay_positions = self.path_positions
+        overlay = {}
+        for (x, y), (nx, ny) in zip(self.path_positions, self.path_positions[1:]):
+            if (x, y) == (nx, ny):
+                continue
+            overlay.setdefault((x, y), set()).add((nx - x, ny - y))
+            overlay.setdefault((nx, ny), set()).add((x - nx, y - ny))
+        self.path_overlay = {cell: tuple(sorted(directions)) for cell, directions in overlay.items()}
+
+    def draw_tiles(self, dirty):
+        # Only tiles that differ from what is on screen are redrawn
+        self.update_path_overlay()
         for y in range(self.height):
+            row = self.level[y]
+            drawn_row = self.drawn_tiles[y]
             for x in range(self.width):
-                tile = self.level[y][x]
+                tile = row[x]
+                path_directions = self.path_overlay.get((x, y), ())
+                drawn = (tile, self.pacman_orientation if tile == 'P' else None, path_directions)
+                if drawn_row[x] == drawn:
+                    continue
+                drawn_row[x] = drawn
                 rect = pygame.Rect(
                     BORDER_THICKNESS + x * self.tile_size,
                     BORDER_THICKNESS + y * self.tile_size,
@@ -213,111 +309,401 @@ class PacManGame:
 
                 pygame.draw.rect(self.screen, (0, 0, 255), rect)
 
-                image = self.images.get(tile)
-                if image:
-                    small_image = pygame.transform.smoothscale(image, (self.tile_size - 4, self.tile_size - 4))
+                if tile == 'P' and self.images.get('P'):
+                    small_image = self.small_pacman_orientations[self.pacman_orientation]
+                else:
+                    small_image = self.small_images.get(tile)
+                if small_image:
                     self.screen.blit(small_image, (rect.x + 2, rect.y + 2))
                 else:
                     pygame.draw.rect(self.screen, TILE_COLORS[tile], rect)
+                for dx, dy in path_directions:
+                    pygame.draw.line(self.screen, PATH_COLOR, rect.center,
+                                     (rect.centerx + dx * self.tile_size // 2, rect.centery + dy * self.tile_size // 2),
+                                     max(2, self.tile_size // 12))
+                dirty.append(rect)
+
+    def draw(self):
+        if self.sprite_tile_size != self.tile_size:
+            self.scale_sprites()
+            self.full_redraw = True
+        # The score list moves down once the average line appears
+        y_start = 80 if self.last_scores else 40
+        if self.screen.get_size() != self.drawn_screen_size or y_start != self.drawn_y_start:
+            self.full_redraw = True
+        if self.full_redraw:
+            self.screen.fill(BACKGROUND_COLOR)
+            self.drawn_tiles = [[None] * self.width for _ in range(self.height)]
+            self.drawn_panels = {}
+            self.drawn_screen_size = self.screen.get_size()
+            self.drawn_y_start = y_start
+        dirty = []
+
+        self.draw_tiles(dirty)
 
         # Penalty top-left
-        penalty_text = self.font.render(f"Penalty: {self.penalty}", True, (255, 255, 255))
-        self.screen.blit(penalty_text, (5, 5))
+        self.draw_text("penalty", f"Penalty: {self.penalty}", dirty, topleft=(5, 5))
 
         if self.last_scores:
-            last_scores_to_consider = 25
-            avg_score = sum(self.last_scores[-last_scores_to_consider:]) / last_scores_to_consider
-            avg_text = self.font.render(f"Average for last {last_scores_to_consider} rounds: {avg_score:.2f}", True, (255, 255, 255))
-            self.screen.blit(avg_text, (5, 40))
-            y_start = 80
-        else:
-            y_start = 40
-
-        # Last Scores
-        self.screen.blit(self.font.render("Last Scores:", True, (255, 255, 255)), (5, y_start))
-        for i, score in enumerate(self.last_scores[-self.max_scores_to_show:][::-1]):
-            score_text = self.font.render(f"{len(self.last_scores) - i}: {score}", True, (255, 255, 255))
-            self.screen.blit(score_text, (5, y_start + 30 + i * 25))
+            self.draw_text("average", f"Average for last {AVERAGE_WINDOW} rounds: {self.last_scores.mean:.2f}", dirty, topleft=(5, 40))
+
+        # Last Scores, redrawn as one panel when a round ends. The list stops
+        # above the controls at the bottom of the window.
+        self.draw_text("scores_title", "Last Scores:", dirty, topleft=(5, y_start))
+        score_count = len(self.last_scores)
+        if self.drawn_panels.get("scores") != score_count:
+            scores_rect = pygame.Rect(0, y_start + 30, BORDER_THICKNESS,
+                                      max(0, self.screen.get_height() - y_start - 30 - SCORES_BOTTOM_MARGIN))
+            self.screen.fill(BACKGROUND_COLOR, scores_rect)
+            max_rows = scores_rect.height // 25
+            for i, score in enumerate(self.last_scores.recent(min(self.max_scores_to_show, max_rows))[::-1]):
+                score_text = self.render_text(f"{score_count - i}: {score}")
+                self.screen.blit(score_text, (5, y_start + 30 + i * 25))
+            dirty.append(scores_rect)
+            self.drawn_panels["scores"] = score_count
 
         # Round top-right
-        round_text = self.font.render(f"Round: {self.round_num}", True, (255, 255, 255))
-        text_rect = round_text.get_rect()
-        self.screen.blit(round_text, (self.screen.get_width() - text_rect.width - 5, 5))
+        self.draw_text("round", f"Round: {self.round_num}", dirty, topright=(self.screen.get_width() - 5, 5))
+
+        # Learner stats below the round, only shown by the background learner
+        if self.steps_per_second is not None:
+            self.draw_text("steps_per_second", f"Steps/sec: {self.steps_per_second:.0f}", dirty,
+                           topright=(self.screen.get_width() - 5, 40))
+        if self.state_value is not None:
+            self.draw_text("state_value", f"V(state): {self.state_value:.2f}", dirty,
+                           topright=(self.screen.get_width() - 5, 75))
+        if profiling.timers.enabled:
+            # Phase timers panel, toggled with the P key
+            right = self.screen.get_width() - 5
+            self.draw_text("profile_title", "Phase: calls, us/call", dirty, topright=(right, 110))
+            for i, (phase, calls, _, per_call_us) in enumerate(profiling.timers.rows()):
+                self.draw_text(f"profile_{phase}", f"{phase}: {calls}, {per_call_us:.1f}", dirty,
+                               topright=(right, 140 + i * 30))
+        if self.trace_position is not None:
+            self.draw_text("trace_position", f"Step: {self.trace_position[0]}/{self.trace_position[1]}", dirty,
+                           topright=(self.screen.get_width() - 5, 40))
 
         # Max penalty centered top
         max_text_value = f"{self.max_penalty}" if self.max_penalty is not None else "-"
-        max_text = self.font.render(f"Best score: {max_text_value}", True, (255, 255, 255))
-        max_rect = max_text.get_rect(center=(self.screen.get_width() // 2, 15))
-        self.screen.blit(max_text, max_rect)
+        self.draw_text("best", f"Best score: {max_text_value}", dirty, center=(self.screen.get_width() // 2, 15))
 
         # Draw resume/pause button
-        resume_stop_button_rect = pygame.Rect(20, self.screen.get_height() - 80, 160, 60)
-        pygame.draw.rect(self.screen, (70, 130, 180), resume_stop_button_rect)
-        resume_stop_button_text_surf = self.font.render(self.resume_stop_button_text, True, (255, 255, 255))
-        resume_stop_button_text_rect = resume_stop_button_text_surf.get_rect(center=resume_stop_button_rect.center)
-        self.screen.blit(resume_stop_button_text_surf, resume_stop_button_text_rect)
-        self.resume_stop_button = resume_stop_button_rect
-        
+        self.resume_stop_button = pygame.Rect(20, self.screen.get_height() - 80, 160, 60)
+        self.draw_button("resume_stop", self.resume_stop_button, self.resume_stop_button_text, DEFAULT_TEXT_FIELD_COLOR, dirty)
+
         # Step forwards button
-        step_forwards_button_rect = pygame.Rect(200, self.screen.get_height() - 80, 160, 60)
-        pygame.draw.rect(self.screen, (70, 130, 180), step_forwards_button_rect)
-        step_forwards_button_text_surf = self.font.render("Step forward", True, (255, 255, 255))
-        step_forwards_button_text_rect = step_forwards_button_text_surf.get_rect(center=step_forwards_button_rect.center)
-        self.screen.blit(step_forwards_button_text_surf, step_forwards_button_text_rect)
-        self.step_forwards_button = step_forwards_button_rect
-        
+        self.step_forwards_button = pygame.Rect(200, self.screen.get_height() - 80, 160, 60)
+        self.draw_button("step_forwards", self.step_forwards_button, "Step forward", DEFAULT_TEXT_FIELD_COLOR, dirty)
+
+        # Step backwards button, only when replaying a trace
+        if self.can_step_backward:
+            self.step_backwards_button = pygame.Rect(200, self.screen.get_height() - 160, 160, 60)
+            self.draw_button("step_backwards", self.step_backwards_button, "Step back", DEFAULT_TEXT_FIELD_COLOR, dirty)
+
         # Input field for adjusting play rate
-        adjust_play_rate_text_field_rect = pygame.Rect(380, self.screen.get_height() - 80, 160, 60)
-        pygame.draw.rect(self.screen, DEFAULT_TEXT_FIELD_COLOR if not game.is_adjust_play_rate_text_field_active else HIGHLIGHTED_TEXT_FIELD_COLOR, adjust_play_rate_text_field_rect)
-        adjust_play_rate_text_field_text_surf = self.font.render(str(game.moves_per_second), True, (255, 255, 255))
-        adjust_play_rate_text_field_text_rect = adjust_play_rate_text_field_text_surf.get_rect(center=adjust_play_rate_text_field_rect.center)
-        self.screen.blit(adjust_play_rate_text_field_text_surf, adjust_play_rate_text_field_text_rect)
-        self.adjust_play_rate_text_field = adjust_play_rate_text_field_rect
+        self.adjust_play_rate_text_field = pygame.Rect(380, self.screen.get_height() - 80, 160, 60)
+        self.draw_button("play_rate", self.adjust_play_rate_text_field, str(self.moves_per_second),
+                         HIGHLIGHTED_TEXT_FIELD_COLOR if self.is_adjust_play_rate_text_field_active else DEFAULT_TEXT_FIELD_COLOR, dirty)
 
         # Text for play rate input field
-        play_rate_surf = self.font.render("moves/sec", True, (255, 255, 255))
-        play_rate_rect = play_rate_surf.get_rect(center=(adjust_play_rate_text_field_rect.center[0], adjust_play_rate_text_field_rect.center[1]-50))
-        self.screen.blit(play_rate_surf, play_rate_rect)
+        center = self.adjust_play_rate_text_field.center
+        self.draw_text("play_rate_label", "moves/sec", dirty, center=(center[0], center[1] - 50))
 
         # Quit program button
-        quit_program_button_rect = pygame.Rect(self.screen.get_width() - 180, self.screen.get_height() - 80, 160, 60)
-        pygame.draw.rect(self.screen, (70, 130, 180), quit_program_button_rect)
-        quit_program_button_text_surf = self.font.render("Quit", True, (255, 255, 255))
-        quit_program_button_text_rect = quit_program_button_text_surf.get_rect(center=quit_program_button_rect.center)
-        self.screen.blit(quit_program_button_text_surf, quit_program_button_text_rect)
-        self.quit_program_button = quit_program_button_rect
-        
+        self.quit_program_button = pygame.Rect(self.screen.get_width() - 180, self.screen.get_height() - 80, 160, 60)
+        self.draw_button("quit", self.quit_program_button, "Quit", DEFAULT_TEXT_FIELD_COLOR, dirty)
+
         # Input field for adjusting gamma
-        adjust_gamma_text_field_rect = pygame.Rect(560, self.screen.get_height() - 80, 160, 60)
-        pygame.draw.rect(self.screen, DEFAULT_TEXT_FIELD_COLOR if not game.is_adjust_gamma_text_field_active else HIGHLIGHTED_TEXT_FIELD_COLOR, adjust_gamma_text_field_rect)
-        adjust_gamma_text_field_text_surf = self.font.render(str(game.gamma), True, (255, 255, 255))
-        adjust_gamma_text_field_text_rect = adjust_gamma_text_field_text_surf.get_rect(center=adjust_gamma_text_field_rect.center)
-        self.screen.blit(adjust_gamma_text_field_text_surf, adjust_gamma_text_field_text_rect)
-        self.adjust_gamma_text_field = adjust_gamma_text_field_rect
-        
+        self.adjust_gamma_text_field = pygame.Rect(560, self.screen.get_height() - 80, 160, 60)
+        self.draw_button("gamma", self.adjust_gamma_text_field, str(self.gamma),
+                         HIGHLIGHTED_TEXT_FIELD_COLOR if self.is_adjust_gamma_text_field_active else DEFAULT_TEXT_FIELD_COLOR, dirty)
+
         # Text for gamma input field
-        gamma_text_surf = self.font.render("Gamma", True, (255, 255, 255))
-        gamma_text_rect = gamma_text_surf.get_rect(center=(adjust_gamma_text_field_rect.center[0], adjust_gamma_text_field_rect.center[1]-50))
-        self.screen.blit(gamma_text_surf, gamma_text_rect)
+        center = self.adjust_gamma_text_field.center
+        self.draw_text("gamma_label", "Gamma", dirty, center=(center[0], center[1] - 50))
+
+        # Replays the best episode so far, not in the trace viewer
+        if self.can_replay_best:
+            self.replay_best_button = pygame.Rect(740, self.screen.get_height() - 80, 160, 60)
+            self.draw_button("replay_best", self.replay_best_button, "Replay best", DEFAULT_TEXT_FIELD_COLOR, dirty)
 
-        pygame.display.flip()
+        if self.full_redraw:
+            pygame.display.flip()
+            self.full_redraw = False
+        elif dirty:
+            pygame.display.update(dirty)
 
     def close(self):
         pygame.quit()
 
     def reset(self):
-        self.level = [row[:] for row in LEVEL]
-        self.find_player()
-        self.penalty = 0
-        self.running = True
+        self.env.reset()
         self.draw()
 
     def get_possible_moves(self):
         return [self.move_left, self.move_right, self.move_up, self.move_down]
 
+def handle_events(game, on_quit):
+    # Buttons, text fields and window events; on_quit is called when the
+    # program should exit
+    for event in pygame.event.get():
+        if event.type == pygame.QUIT:
+            on_quit()
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            if hasattr(game, 'resume_stop_button') and game.resume_stop_button.collidepoint(event.pos):
+                if game.is_paused:
+                    game.resume_stop_button_text = "Stop"
+                    game.is_paused = False
+                else:
+                    game.resume_stop_button_text = "Start"
+                    game.is_paused = True
+                game.draw()
+            if hasattr(game, 'step_forwards_button') and game.step_forwards_button.collidepoint(event.pos):
+                if game.is_paused:
+                    game.perform_step_forward = True
+            if hasattr(game, 'step_backwards_button') and game.step_backwards_button.collidepoint(event.pos):
+                if game.is_paused:
+                    game.perform_step_backward = True
+            if (game.can_replay_best and hasattr(game, 'replay_best_button')
+                    and game.replay_best_button.collidepoint(event.pos)):
+                game.replay_requested = True
+            if hasattr(game, 'adjust_play_rate_text_field') and game.adjust_play_rate_text_field.collidepoint(event.pos):
+                game.is_adjust_play_rate_text_field_active = True
+            else:
+                game.is_adjust_play_rate_text_field_active = False
+            if hasattr(game, 'adjust_gamma_text_field') and game.adjust_gamma_text_field.collidepoint(event.pos):
+                game.is_adjust_gamma_text_field_active = True
+            else:
+                game.is_adjust_gamma_text_field_active = False
+            game.draw()
+            if hasattr(game, 'quit_program_button') and game.quit_program_button.collidepoint(event.pos):
+                on_quit()
+        elif event.type == pygame.KEYDOWN:
+            if not game.is_adjust_play_rate_text_field_active and not game.is_adjust_gamma_text_field_active:
+                # Arrow keys: left/right step while paused, up/down switch the
+                # episode in the trace viewer
+                if event.key == pygame.K_RIGHT and game.is_paused:
+                    game.perform_step_forward = True
+                elif event.key == pygame.K_LEFT and game.is_paused and game.can_step_backward:
+                    game.perform_step_backward = True
+                elif event.key == pygame.K_UP:
+                    game.episode_change = -1
+                elif event.key == pygame.K_DOWN:
+                    game.episode_change = 1
+                elif event.key == pygame.K_p:
+                    profiling.timers.toggle()
+                    game.full_redraw = True
+            if hasattr(game, 'adjust_play_rate_text_field') and game.is_adjust_play_rate_text_field_active:
+                if event.key == pygame.K_BACKSPACE:
+                    game.moves_per_second = game.moves_per_second[:-1]
+                else:
+                    game.moves_per_second += event.unicode
+            if hasattr(game, 'adjust_gamma_text_field') and game.is_adjust_gamma_text_field_active:
+                if event.key == pygame.K_BACKSPACE:
+                    game.gamma = game.gamma[:-1]
+                else:
+                    game.gamma += event.unicode
+                game.draw()
+
+
+def replay_best(game, on_quit):
+    # Plays the actions of the agent's best episode from the start at the
+    # current moves/sec, without learning and without counting the round
+    game.replay_requested = False
+    actions = list(agent.best_actions)
+    if not actions:
+        print("No finished episode to replay yet")
+        return
+    move_mapping = {
+        'left': game.move_left,
+        'right': game.move_right,
+        'up': game.move_up,
+        'down': game.move_down,
+    }
+    game.reset()
+    print(f"Replaying the best episode ({len(actions)} moves, penalty {agent.best_penalty})")
+    last_step_time = pygame.time.get_ticks()
+    while actions and game.running:
+        try:
+            step_delay = 1000 / float(game.moves_per_second)
+        except:
+            step_delay = 1000
+        current_time = pygame.time.get_ticks()
+        if current_time - last_step_time >= step_delay:
+            last_step_time = current_time
+            move_mapping[actions.pop(0)]()
+        handle_events(game, on_quit)
+        pygame.time.wait(PAUSE)
+    print(f"Replay finished. Penalty: {game.penalty}")
+
+
+ORIENTATION_OF_ACTION = {
+    'left': "facing_left",
+    'right': "facing_right",
+    'up': "facing_up_clockwise",
+    'down': "facing_down_clockwise",
+}
+
+
+def run_trace_viewer(game, trace_path, episode=None):
+    # Shows recorded episodes from a trace file (see traces.py). Start/Stop
+    # plays the episode, Step forward/back and the arrow keys scrub through
+    # it and up/down switch to the previous/next episode. The agent is not
+    # used, every position is replayed from the recorded actions.
+    from traces import TraceFile, TraceReplay
+    trace = TraceFile(trace_path, level_id(game.env.initial_level))
+    if not len(trace):
+        print(f"{trace_path} has no episodes")
+        sys.exit(1)
+    index = trace.best_index() if episode is None else max(0, min(episode - 1, len(trace) - 1))
+    game.can_step_backward = True
+    game.can_replay_best = False
+    game.max_penalty = trace.penalties[trace.best_index()]
+    game.last_scores.extend(trace.penalties)
+
+    def quit_program():
+        sys.exit(0)
+
+    def show(step):
+        step = replay.seek(step)
+        if step > 0:
+            game.change_pacman_orientation(ORIENTATION_OF_ACTION[replay.actions[step - 1]])
+        game.trace_position = (step, len(replay.actions))
+
+    replay = None
+    last_step_time = pygame.time.get_ticks()
+    while True:
+        if replay is None:
+            game.round_num = index + 1
+            replay = TraceReplay(game.env, trace.actions(index))
+            show(0)
+        handle_events(game, quit_program)
+        try:
+            step_delay = 1000 / float(game.moves_per_second)
+        except:
+            step_delay = 1000
+        current_time = pygame.time.get_ticks()
+        if game.episode_change:
+            index = max(0, min(index + game.episode_change, len(trace) - 1))
+            game.episode_change = 0
+            replay = None
+            continue
+        if game.perform_step_forward or (not game.is_paused and current_time - last_step_time >= step_delay):
+            game.perform_step_forward = False
+            last_step_time = current_time
+            show(replay.step + 1)
+        if game.perform_step_backward:
+            game.perform_step_backward = False
+            show(replay.step - 1)
+        game.draw()
+        game.clock.tick(FPS)
+
+
+def default_value_table_path(level):
+    # Every level gets its own file, so playing another level never
+    # overwrites the table learned for LEVEL
+    if level_id(level) == level_id(LEVEL):
+        return VALUE_TABLE_PATH
+    return f"value_table_{level_id(level):08x}.bin"
+
+
+def run_background_learner(game, checkpointer, metrics_writer=None):
+    # The agent learns flat out in a worker thread; this loop only handles
+    # events and draws snapshots of the learner's episode at display FPS
+    from learner import BackgroundLearner
+
+    def on_episode_end(round_num, penalty, steps):
+        if metrics_writer is not None:
+            metrics_writer.write(round_num, penalty, steps, len(agent.V))
+        if checkpointer is not None:
+            checkpointer.maybe_save(round_num)
+
+    learner = BackgroundLearner(agent, game.env.initial_level, on_episode_end=on_episode_end,
+                                scores=game.last_scores)
+    learner.start()
+
+    def quit_program():
+        learner.stop()
+        learner.join()
+        if metrics_writer is not None:
+            metrics_writer.close()
+        if checkpointer is not None:
+            checkpointer.close()
+        sys.exit(0)
+
+    while True:
+        handle_events(game, quit_program)
+        learner.set_paused(game.is_paused)
+        if game.perform_step_forward:
+            game.perform_step_forward = False
+            learner.request_step()
+        if game.replay_requested:
+            # The learner keeps its own environment, the replay uses the one
+            # that is drawn
+            learner.set_paused(True)
+            replay_best(game, quit_program)
+
+        game.state_value = learner.snapshot_into(game.env)
+        game.path_positions = agent.greedy_path(game.env)[1]
+        game.round_num = learner.round_num
+        game.max_penalty = learner.max_penalty
+        game.steps_per_second = learner.steps_per_second
+        game.draw()
+        game.clock.tick(FPS)
+
+
 if __name__ == "__main__":
+    import argparse
+    from value_store import Checkpointer, KEY_BITS
+    parser = argparse.ArgumentParser(description="PacMan with TD(0)")
+    parser.add_argument("--background", action="store_true",
+                        help="learn in a worker thread at full speed and only sample it for display")
+    parser.add_argument("--trace", default=None, help="view the episodes recorded in this trace file")
+    parser.add_argument("--episode", type=int, default=None,
+                        help="episode of --trace to show first (default: the best one)")
+    parser.add_argument("--metrics", default=None,
+                        help="stream per-round metrics to this .csv or .jsonl file")
+    parser.add_argument("--profile", action="store_true",
+                        help="start with the phase timers on (toggle them with the P key)")
+    parser.add_argument("--value-table", default=None,
+                        help=f"value table to resume from and checkpoint to (default: {VALUE_TABLE_PATH} for "
+                             "the built-in level, a file named after the level id otherwise)")
+    add_level_arguments(parser)
+    args = parser.parse_args()
+    level = level_from_args(args, LEVEL)
+    profiling.register_agent_phases()
+    profiling.register(PacManGame, "draw", "draw")
+    profiling.register(sys.modules[__name__], "handle_events", "handle_events")
+    if args.profile:
+        profiling.enable()
+    if args.trace:
+        run_trace_viewer(PacManGame(level, start_maximized=True), args.trace, args.episode)
     start_maximized = True
-    game = PacManGame(LEVEL, start_maximized=start_maximized)
+    game = PacManGame(level, start_maximized=start_maximized)
+    value_table_path = args.value_table or default_value_table_path(level)
+    checkpointer = None
+    if game.encoder.key_bits > KEY_BITS:
+        print(f"State keys of this level need {game.encoder.key_bits} bits, "
+              f"the value table is not saved (the file format holds {KEY_BITS})")
+    else:
+        if os.path.exists(value_table_path):
+            try:
+                agent.load(value_table_path, level_id(level))
+                print(f"Loaded {len(agent.V)} states from {value_table_path}")
+            except ValueError as error:
+                print(f"Not resuming from {value_table_path}: {error}")
+        checkpointer = Checkpointer(agent, value_table_path, CHECKPOINT_EVERY_ROUNDS, level_id(level))
+    metrics_writer = MetricsWriter(args.metrics) if args.metrics else None
+    if args.background:
+        run_background_learner(game, checkpointer, metrics_writer)
+
+    def quit_program():
+        if metrics_writer is not None:
+            metrics_writer.close()
+        if checkpointer is not None:
+            checkpointer.close()
+        sys.exit(0)
+
     round_num = 0
 
     move_mapping = {
@@ -328,18 +714,32 @@ if __name__ == "__main__":
     }
     
     while True:
+        if game.replay_requested:
+            replay_best(game, quit_program)
         game.round_num = round_num + 1
         game.reset()
+        game.path_positions = agent.greedy_path(game.env)[1]
 
         print(f"Round {game.round_num} start!")
 
         state = agent.get_state(game)
-        
+        steps = 0
+
         last_step_time = pygame.time.get_ticks()
         # milliseconds between moves. 
         # E.g. MOVES_PER_SECOND = 2 --> 2 moves per second --> 500ms delay between each move
 
+        abandoned = False
         while game.running:
+            if game.replay_requested:
+                if not agent.best_actions:
+                    # Only reports that there is nothing to replay yet
+                    replay_best(game, quit_program)
+                else:
+                    # Replay right away instead of after the current round,
+                    # which is dropped and started over
+                    abandoned = True
+                    break
             try:
                 STEP_DELAY = 1000 / float(game.moves_per_second)
             except:
@@ -357,55 +757,29 @@ if __name__ == "__main__":
                 reward = game.penalty - old_penalty
                 new_state = agent.get_state(game)
                 agent.update(old_state, reward, new_state)
-            
-            # Event handling
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    running = False
-                elif event.type == pygame.MOUSEBUTTONDOWN:
-                    if hasattr(game, 'resume_stop_button') and game.resume_stop_button.collidepoint(event.pos):
-                        if game.is_paused:
-                            game.resume_stop_button_text = "Stop"
-                            game.is_paused = False
-                        else:
-                            game.resume_stop_button_text = "Start"
-                            game.is_paused = True
-                        game.draw()
-                    if hasattr(game, 'step_forwards_button') and game.step_forwards_button.collidepoint(event.pos):
-                        if game.is_paused:
-                            game.perform_step_forward = True
-                    if hasattr(game, 'adjust_play_rate_text_field') and game.adjust_play_rate_text_field.collidepoint(event.pos):
-                        game.is_adjust_play_rate_text_field_active = True
-                    else:
-                        game.is_adjust_play_rate_text_field_active = False
-                    if hasattr(game, 'adjust_gamma_text_field') and game.adjust_gamma_text_field.collidepoint(event.pos):
-                        game.is_adjust_gamma_text_field_active = True
-                    else:
-                        game.is_adjust_gamma_text_field_active = False
-                    game.draw()
-                    if hasattr(game, 'quit_program_button') and game.quit_program_button.collidepoint(event.pos):
-                        running = False
-                        sys.exit(0)
-                elif event.type == pygame.KEYDOWN:
-                    if hasattr(game, 'adjust_play_rate_text_field') and game.is_adjust_play_rate_text_field_active:
-                        if event.key == pygame.K_BACKSPACE:
-                            game.moves_per_second = game.moves_per_second[:-1]
-                        else:
-                            game.moves_per_second += event.unicode
-                    if hasattr(game, 'adjust_gamma_text_field') and game.is_adjust_gamma_text_field_active:
-                        if event.key == pygame.K_BACKSPACE:
-                            game.gamma = game.gamma[:-1]
-                        else:
-                            game.gamma += event.unicode
-                        game.draw()
+                steps += 1
+                game.path_positions = agent.greedy_path(game.env)[1]
+
+            handle_events(game, quit_program)
             pygame.time.wait(PAUSE)
 
+        if abandoned:
+            agent.end_episode()
+            continue
+
+        agent.end_episode(game.penalty)
 
         # Update score tracking
         if game.max_penalty is None or game.penalty < game.max_penalty:
             game.max_penalty = game.penalty
         game.last_scores.append(game.penalty)
+        if metrics_writer is not None:
+            metrics_writer.write(game.round_num, game.penalty, steps, len(agent.V))
 
         print(f"Round {game.round_num} ended. Penalty: {game.penalty} | Best score: {game.max_penalty}")
+        if profiling.timers.enabled:
+            print(profiling.report())
+        if checkpointer is not None:
+            checkpointer.maybe_save(game.round_num)
         pygame.time.wait(PAUSE)
         round_num += 1
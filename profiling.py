@@ -0,0 +1,107 @@
+import functools
+import time
+
+# Per-phase call counts and cumulative time for the hot path.
+#
+# Instrumentation works by replacing the registered functions with timing
+# wrappers while it is enabled and putting the originals back when it is
+# disabled, so a run without profiling executes exactly the same code as
+# before. Phases are registered as (owner, attribute name, phase name); the
+# owner is a class or a module. Times of nested phases are included in the
+# outer phase (choose_action contains simulate_adjacent_states).
+#
+#   profiling.enable()
+#   ...
+#   print(profiling.report())
+#   profiling.disable()
+
+
+class PhaseTimers:
+    def __init__(self):
+        self.targets = []
+        self.originals = {}
+        self.counts = {}
+        self.totals_ns = {}
+        self.enabled = False
+
+    def register(self, owner, attribute, phase):
+        if any(target[:2] == (owner, attribute) for target in self.targets):
+            return
+        self.targets.append((owner, attribute, phase))
+        self.counts.setdefault(phase, 0)
+        self.totals_ns.setdefault(phase, 0)
+        if self.enabled:
+            self.wrap(owner, attribute, phase)
+
+    def wrap(self, owner, attribute, phase):
+        original = getattr(owner, attribute)
+        self.originals[(owner, attribute)] = original
+        counts = self.counts
+        totals_ns = self.totals_ns
+        clock = time.perf_counter_ns
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                totals_ns[phase] += clock() - start
+                counts[phase] += 1
+        setattr(owner, attribute, timed)
+
+    def enable(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        for owner, attribute, phase in self.targets:
+            self.wrap(owner, attribute, phase)
+
+    def disable(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        for (owner, attribute), original in self.originals.items():
+            setattr(owner, attribute, original)
+        self.originals.clear()
+
+    def toggle(self):
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def reset(self):
+        for phase in self.counts:
+            self.counts[phase] = 0
+            self.totals_ns[phase] = 0
+
+    def rows(self):
+        # (phase, calls, total ms, µs per call) for every phase that ran
+        return [(phase, self.counts[phase], self.totals_ns[phase] / 1e6,
+                 self.totals_ns[phase] / self.counts[phase] / 1e3)
+                for phase in self.counts if self.counts[phase]]
+
+    def report(self):
+        lines = [f"{'phase':<26}{'calls':>10}{'total ms':>12}{'us/call':>10}"]
+        for phase, calls, total_ms, per_call_us in self.rows():
+            lines.append(f"{phase:<26}{calls:>10}{total_ms:>12.1f}{per_call_us:>10.2f}")
+        return "\n".join(lines)
+
+
+timers = PhaseTimers()
+register = timers.register
+enable = timers.enable
+disable = timers.disable
+report = timers.report
+
+
+def register_agent_phases():
+    # The phases every front end shares: the agent and the environment
+    from td_agent import TDAgent
+    from pacman_env import PacManEnv
+    register(TDAgent, "get_state", "get_state")
+    register(TDAgent, "simulate_adjacent_states", "simulate_adjacent_states")
+    register(TDAgent, "choose_action", "choose_action")
+    register(TDAgent, "update", "update")
+    register(PacManEnv, "step", "env.step")
@@ -0,0 +1,235 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import time
+import traceback
+from collections import defaultdict
+import numpy as np
+from pacman_env import PacManEnv, LEVEL, HASHING_MODES
+from td_agent import TDAgent
+from train import run_episode, DEFAULT_MAX_STEPS
+from levels import add_level_arguments, level_from_args
+from value_store import SharedValueTable
+
+# Several worker processes training one value function on the same level.
+#
+# The values live in a SharedValueTable in shared memory. Each worker runs
+# plain TD(0) episodes against a local dict copy (so the hot loop is exactly
+# the single-process one) and every `sync_steps` steps merges: it pushes the
+# change of every local value since the last merge into the shared table
+# (added, so concurrent changes from other workers are kept) and pulls the
+# merged table back. Reads never take the lock, writes take it once per
+# merge.
+#
+# Between merges every worker moves the values it visits most of the way to
+# its own TD targets, so adding all of those changes overshoots by up to a
+# factor of `workers` when merges are far apart. merge="average" scales each
+# worker's changes by 1 / workers, which is stable for any interval;
+# merge="sum" adds them unscaled, which learns faster but needs a short
+# `sync_steps` (a few hundred steps) to stay stable.
+#
+#   python shared_train.py --workers 1,2,4 --episodes 20000
+#
+# reports steps/sec and episodes until the rolling average penalty reaches a
+# target for every worker count, next to a single-process TDAgent.
+DEFAULT_CAPACITY = 1 << 22
+DEFAULT_SYNC_STEPS = 20000
+MERGE_MODES = ("average", "sum")
+WORKER_POLL_SECONDS = 1.0
+
+
+def pull(table):
+    # Sorted (keys, values) of the shared table, kept as the base for the
+    # next push
+    keys, values = table.items()
+    order = np.argsort(keys)
+    return keys[order], values[order]
+
+
+def push(V, base, table, scale=1.0):
+    base_keys, base_values = base
+    count = len(V)
+    try:
+        keys = np.fromiter(V.keys(), dtype=np.uint64, count=count)
+    except OverflowError:
+        raise ValueError("state keys do not fit into 64 bits, use --hashing zobrist")
+    values = np.fromiter(V.values(), dtype=np.float64, count=count)
+    index = np.minimum(np.searchsorted(base_keys, keys), max(len(base_keys) - 1, 0))
+    known = base_keys[index] == keys if len(base_keys) else np.zeros(count, dtype=bool)
+    deltas = values - np.where(known, base_values[index] if len(base_keys) else 0.0, 0.0)
+    changed = deltas != 0
+    if changed.any():
+        table.add(keys[changed], deltas[changed] * scale)
+
+
+def sync(agent, table, base, scale):
+    push(agent.V, base, table, scale)
+    base = pull(table)
+    agent.V = defaultdict(float, zip(base[0].tolist(), base[1].tolist()))
+    return base
+
+
+def worker(*args):
+    # Reports ("done", penalties, steps) or ("error", traceback, None) on the
+    # results queue, which is the last argument, so the parent never waits
+    # for a worker that has failed
+    results = args[-1]
+    try:
+        finished, total_steps = train_worker(*args[:-1])
+    except BaseException:
+        results.put(("error", traceback.format_exc(), None))
+    else:
+        results.put(("done", finished, total_steps))
+
+
+def train_worker(table_name, capacity, lock, level, hashing, episodes, seed, hyperparameters, max_steps, sync_steps,
+                 scale):
+    random.seed(seed)
+    agent = TDAgent(*hyperparameters)
+    table = SharedValueTable(capacity, lock, table_name)
+    base = pull(table)
+    agent.V = defaultdict(float, zip(base[0].tolist(), base[1].tolist()))
+    env = PacManEnv(level, hashing)
+    finished = []
+    total_steps = 0
+    steps_since_sync = 0
+    for _ in range(episodes):
+        penalty, steps = run_episode(env, agent, max_steps)
+        # perf_counter is system wide, so workers' timelines can be merged
+        finished.append((time.perf_counter(), penalty))
+        total_steps += steps
+        steps_since_sync += steps
+        if steps_since_sync >= sync_steps:
+            base = sync(agent, table, base, scale)
+            steps_since_sync = 0
+    push(agent.V, base, table, scale)
+    del agent, base
+    table.close()
+    return finished, total_steps
+
+
+def train_shared(episodes, workers, level=LEVEL, hashing="exact", seed=0, hyperparameters=(),
+                 max_steps=DEFAULT_MAX_STEPS, sync_steps=DEFAULT_SYNC_STEPS, capacity=DEFAULT_CAPACITY, initial=None,
+                 merge="average"):
+    # Splits `episodes` over `workers` processes, starting from the values in
+    # `initial` if given. Returns the penalties in completion order, the
+    # total number of steps, the wall time and the merged value table as a
+    # defaultdict.
+    if merge not in MERGE_MODES:
+        raise ValueError(f"merge must be one of {', '.join(MERGE_MODES)}")
+    scale = 1.0 / workers if merge == "average" else 1.0
+    lock = multiprocessing.Lock()
+    table = SharedValueTable(capacity, lock)
+    if initial:
+        push(initial, (np.zeros(0, dtype=np.uint64), np.zeros(0)), table)
+    results = multiprocessing.Queue()
+    processes = []
+    start = time.perf_counter()
+    try:
+        for i in range(workers):
+            share = episodes // workers + (1 if i < episodes % workers else 0)
+            process = multiprocessing.Process(target=worker, args=(
+                table.name, capacity, lock, level, hashing, share, seed + i, hyperparameters, max_steps,
+                sync_steps, scale, results))
+            process.start()
+            processes.append(process)
+        finished = []
+        total_steps = 0
+        remaining = len(processes)
+        while remaining:
+            try:
+                status, payload, worker_steps = results.get(timeout=WORKER_POLL_SECONDS)
+            except queue.Empty:
+                # A worker killed without reaching its except clause
+                for process in processes:
+                    if process.exitcode not in (None, 0):
+                        raise RuntimeError(f"shared training worker exited with code {process.exitcode}")
+                continue
+            if status == "error":
+                raise RuntimeError(f"shared training worker failed:\n{payload}")
+            finished.extend(payload)
+            total_steps += worker_steps
+            remaining -= 1
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+        keys, values = table.items()
+        V = defaultdict(float, zip(keys.tolist(), values.tolist()))
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+        table.close()
+    finished.sort()
+    return [penalty for _, penalty in finished], total_steps, elapsed, V
+
+
+def train_single(episodes, level, hashing, seed, hyperparameters, max_steps):
+    random.seed(seed)
+    agent = TDAgent(*hyperparameters)
+    env = PacManEnv(level, hashing)
+    penalties = []
+    total_steps = 0
+    start = time.perf_counter()
+    for _ in range(episodes):
+        penalty, steps = run_episode(env, agent, max_steps)
+        penalties.append(penalty)
+        total_steps += steps
+    return penalties, total_steps, time.perf_counter() - start
+
+
+def int_list(text):
+    return [int(value) for value in text.split(",")]
+
+
+if __name__ == "__main__":
+    from convergence import exit_path_penalty, episodes_to_target
+
+    parser = argparse.ArgumentParser(description="Train one shared value table with several processes.")
+    parser.add_argument("--workers", type=int_list, default=[1, 2, 4],
+                        help="comma separated worker counts to compare")
+    parser.add_argument("--episodes", type=int, default=20000, help="episodes per run, split over the workers")
+    parser.add_argument("--learning-rate", type=float, default=0.05)
+    parser.add_argument("--discount-factor", type=float, default=1)
+    parser.add_argument("--exploration-rate", type=float, default=0.05)
+    parser.add_argument("--max-steps", type=int, default=DEFAULT_MAX_STEPS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--hashing", choices=HASHING_MODES, default="exact")
+    parser.add_argument("--sync-steps", type=int, default=DEFAULT_SYNC_STEPS,
+                        help="steps each worker takes between merges with the shared table")
+    parser.add_argument("--merge", choices=MERGE_MODES, default="average",
+                        help="average the workers' changes or add them (needs a small --sync-steps)")
+    parser.add_argument("--capacity", type=int, default=DEFAULT_CAPACITY,
+                        help="slots in the shared table, a power of two")
+    parser.add_argument("--window", type=int, default=100, help="episodes in the rolling average")
+    parser.add_argument("--target", type=float, default=None,
+                        help="target average penalty (default: the exit path penalty)")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    add_level_arguments(parser)
+    args = parser.parse_args()
+    level = level_from_args(args, LEVEL)
+
+    target = args.target if args.target is not None else exit_path_penalty(level)
+    hyperparameters = (args.learning_rate, args.discount_factor, args.exploration_rate)
+    penalties, steps, elapsed = train_single(args.episodes, level, args.hashing, args.seed, hyperparameters,
+                                             args.max_steps)
+    runs = {"single": {"steps_per_second": steps / elapsed, "seconds": elapsed,
+                       "episodes_to_target": episodes_to_target(penalties, target, args.window)}}
+    for workers in args.workers:
+        penalties, steps, elapsed, _ = train_shared(args.episodes, workers, level, args.hashing, args.seed,
+                                                    hyperparameters, args.max_steps, args.sync_steps, args.capacity,
+                                                    merge=args.merge)
+        runs[f"workers_{workers}"] = {"steps_per_second": steps / elapsed, "seconds": elapsed,
+                                      "episodes_to_target": episodes_to_target(penalties, target, args.window)}
+    report = {"target": target, "window": args.window, "episodes": args.episodes, "merge": args.merge,
+              "sync_steps": args.sync_steps, "cpus": os.cpu_count(),
+              "runs": runs}
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
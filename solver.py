@@ -0,0 +1,290 @@
+import argparse
+import heapq
+import random
+import time
+from collections import deque
+from pacman_env import PacManEnv, LEVEL, TILE_PENALTIES
+from levels import validate_level
+
+# Exact optimal baseline for a level: A* over the compact (position,
+# remaining collectibles) state space, using the same successor tables as
+# the agent.
+#
+# To get non-negative edge costs the search works with reduced costs: the
+# reward of a move is shifted by the change of the potential
+#
+#   phi(state) = sum of (TILE_PENALTIES[' '] - TILE_PENALTIES[tile])
+#                over the dots and stars still on the board
+#
+# which makes every non-terminal move cost exactly 1, reaching the exit cost 0
+# and hitting a ghost cost 100. A finished episode additionally pays
+# phi(final state) for everything it left behind. The heuristic is a lower
+# bound on that remaining cost computed on the bridge tree of the maze: a
+# branch that does not lead to the exit has to be entered and left again, so
+# eating anything in it costs at least two moves per bridge crossed, and of
+# the branches that do lead to an exit only one has to be walked to its end.
+
+GHOST_PENALTY = TILE_PENALTIES['G']
+
+
+class LevelSolver:
+    def __init__(self, level=LEVEL):
+        self.env = PacManEnv(level)
+        self.encoder = self.env.encoder
+        level = self.env.initial_level
+        width = self.encoder.width
+        height = self.encoder.height
+
+        # Cost of leaving each collectible behind, grouped by weight so the
+        # potential of a mask is a handful of popcounts
+        self.weight_masks = {}
+        for bit, (x, y) in enumerate(self.encoder.collectible_cells):
+            tile = level[y][x]
+            if tile == 'G':
+                continue
+            weight = TILE_PENALTIES[' '] - TILE_PENALTIES[tile]
+            self.weight_masks[weight] = self.weight_masks.get(weight, 0) | (1 << bit)
+        self.item_mask = 0
+        for mask in self.weight_masks.values():
+            self.item_mask |= mask
+
+        # Graph of cells the player can walk through (ghosts end the episode)
+        self.neighbours = {}
+        for y in range(height):
+            for x in range(width):
+                if level[y][x] in ('X', 'G'):
+                    continue
+                self.neighbours[y * width + x] = [
+                    ny * width + nx
+                    for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1))
+                    if 0 <= nx < width and 0 <= ny < height and level[ny][nx] not in ('X', 'G')
+                ]
+        self.exit_cells = [y * width + x for y in range(height) for x in range(width) if level[y][x] == 'E']
+        self.exit_distance = self.distances_from(self.exit_cells)
+        self.build_bridge_tree()
+
+    def distances_from(self, cells):
+        distance = {cell: 0 for cell in cells}
+        queue = deque(cells)
+        while queue:
+            cell = queue.popleft()
+            for neighbour in self.neighbours[cell]:
+                if neighbour not in distance:
+                    distance[neighbour] = distance[cell] + 1
+                    queue.append(neighbour)
+        return distance
+
+    def find_bridges(self):
+        bridges = set()
+        order = {}
+        low = {}
+        for root in self.neighbours:
+            if root in order:
+                continue
+            order[root] = low[root] = len(order)
+            stack = [(root, None, iter(self.neighbours[root]))]
+            while stack:
+                cell, parent, children = stack[-1]
+                for child in children:
+                    if child == parent:
+                        continue
+                    if child in order:
+                        low[cell] = min(low[cell], order[child])
+                    else:
+                        order[child] = low[child] = len(order)
+                        stack.append((child, cell, iter(self.neighbours[child])))
+                        break
+                else:
+                    stack.pop()
+                    if parent is not None:
+                        low[parent] = min(low[parent], low[cell])
+                        if low[cell] > order[parent]:
+                            bridges.add((parent, cell))
+                            bridges.add((cell, parent))
+        return bridges
+
+    def build_bridge_tree(self):
+        bridges = self.find_bridges()
+
+        # Two-edge-connected components are what is left after removing bridges
+        self.component_of = {}
+        num_components = 0
+        for start in self.neighbours:
+            if start in self.component_of:
+                continue
+            self.component_of[start] = num_components
+            queue = deque([start])
+            while queue:
+                cell = queue.popleft()
+                for neighbour in self.neighbours[cell]:
+                    if neighbour not in self.component_of and (cell, neighbour) not in bridges:
+                        self.component_of[neighbour] = num_components
+                        queue.append(neighbour)
+            num_components += 1
+
+        # Collectibles on a cell next to a bridge may be eaten by the move that
+        # crosses the bridge, which is already counted; all others need a move
+        # of their own.
+        self.component_masks = [0] * num_components
+        self.inner_masks = [0] * num_components
+        tree = [[] for _ in range(num_components)]
+        for (a, b) in bridges:
+            tree[self.component_of[a]].append(self.component_of[b])
+        for cell, component in self.component_of.items():
+            bit = self.encoder.bit_of_cell[cell]
+            if bit is None or not (self.item_mask >> bit) & 1:
+                continue
+            self.component_masks[component] |= 1 << bit
+            if not any((cell, neighbour) in bridges for neighbour in self.neighbours[cell]):
+                self.inner_masks[component] |= 1 << bit
+        self.exit_components = exit_components = {self.component_of[cell] for cell in self.exit_cells}
+
+        # For every possible root: children before parents, plus whether the
+        # subtree below the edge contains an exit
+        self.post_orders = []
+        for root in range(num_components):
+            order = []
+            seen = {root}
+            stack = [(root, None)]
+            while stack:
+                component, parent = stack.pop()
+                order.append((component, parent))
+                for child in tree[component]:
+                    if child not in seen:
+                        seen.add(child)
+                        stack.append((child, component))
+            contains_exit = [False] * num_components
+            post_order = []
+            for component, parent in reversed(order):
+                if component in exit_components:
+                    contains_exit[component] = True
+                if parent is not None:
+                    contains_exit[parent] = contains_exit[parent] or contains_exit[component]
+                    post_order.append((component, parent, contains_exit[component]))
+            self.post_orders.append((post_order, contains_exit[root]))
+
+    def potential(self, mask):
+        return sum(weight * bin(mask & weight_mask).count("1") for weight, weight_mask in self.weight_masks.items())
+
+    def heuristic(self, key):
+        mask, cell = divmod(key, self.encoder.num_cells)
+        post_order, exit_reachable = self.post_orders[self.component_of[cell]]
+        if not exit_reachable:
+            return GHOST_PENALTY
+        # tour: cost of a round trip through the subtree that eats or skips
+        # everything in it; finish: extra cost of ending the episode on an exit
+        # inside the subtree instead of coming back. Only one exit is reached,
+        # so only the cheapest branch towards an exit is charged as the final
+        # one and the others count like ordinary branches.
+        tour = [bin(mask & inner).count("1") for inner in self.inner_masks]
+        skip = [self.potential(mask & component_mask) for component_mask in self.component_masks]
+        finish = [0 if component in self.exit_components else None for component in range(len(tour))]
+        for component, parent, contains_exit in post_order:
+            branch = min(skip[component], 2 + tour[component])
+            tour[parent] += branch
+            skip[parent] += skip[component]
+            if contains_exit:
+                extra = 1 + tour[component] + finish[component] - branch
+                if finish[parent] is None or extra < finish[parent]:
+                    finish[parent] = extra
+        root = self.component_of[cell]
+        return min(max(tour[root] + finish[root], self.exit_distance[cell]) - 1, GHOST_PENALTY)
+
+    def solve(self):
+        # Returns (optimal_penalty, actions) from the level's start state, or
+        # (None, None) if no terminal tile can be reached
+        num_cells = self.encoder.num_cells
+        action_names = self.encoder.action_names
+        self.env.reset()
+        start = self.env.state_key
+        start_potential = self.potential(start // num_cells)
+
+        best_cost = {start: 0}
+        came_from = {}
+        queue = [(self.heuristic(start), 0, start)]
+        best_total = None
+        best_end = None
+        while queue:
+            estimate, cost, key = heapq.heappop(queue)
+            if best_total is not None and estimate >= best_total:
+                break
+            if cost > best_cost[key]:
+                continue
+            potential = self.potential(key // num_cells)
+            for action, (next_key, reward, terminal) in zip(action_names, self.encoder.successors(key)):
+                next_potential = self.potential(next_key // num_cells)
+                next_cost = cost + reward + potential - next_potential
+                if terminal:
+                    total = next_cost + next_potential
+                    if best_total is None or total < best_total:
+                        best_total = total
+                        best_end = (key, action)
+                    continue
+                if next_cost < best_cost.get(next_key, next_cost + 1):
+                    best_cost[next_key] = next_cost
+                    came_from[next_key] = (key, action)
+                    heapq.heappush(queue, (next_cost + self.heuristic(next_key), next_cost, next_key))
+
+        if best_end is None:
+            return None, None
+        key, action = best_end
+        actions = [action]
+        while key != start:
+            key, action = came_from[key]
+            actions.append(action)
+        actions.reverse()
+        return best_total - start_potential, actions
+
+
+def solve(level=LEVEL):
+    return LevelSolver(level).solve()
+
+
+def random_level(rng, width, height, exits):
+    # Small random level with several exits for checking the heuristic
+    while True:
+        tiles = rng.choices(" .*XG", weights=[3, 4, 1, 2, 1], k=width * height)
+        cells = rng.sample(range(width * height), exits + 1)
+        tiles[cells[0]] = 'P'
+        for cell in cells[1:]:
+            tiles[cell] = 'E'
+        level = [tiles[y * width:(y + 1) * width] for y in range(height)]
+        try:
+            validate_level(level)
+        except ValueError:
+            continue
+        return level
+
+
+def check(trials, seed=0):
+    # Compares A* against plain Dijkstra (heuristic 0) on random multi-exit
+    # levels; returns the levels where the penalties differ
+    rng = random.Random(seed)
+    mismatches = []
+    for _ in range(trials):
+        level = random_level(rng, rng.randint(3, 6), rng.randint(2, 5), rng.randint(2, 3))
+        penalty, _ = LevelSolver(level).solve()
+        dijkstra = LevelSolver(level)
+        dijkstra.heuristic = lambda key: 0
+        expected, _ = dijkstra.solve()
+        if penalty != expected:
+            mismatches.append((level, penalty, expected))
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Optimal penalty and path for LEVEL.")
+    parser.add_argument("--check", type=int, default=0, metavar="N",
+                        help="instead compare against plain Dijkstra on N random multi-exit levels")
+    args = parser.parse_args()
+    if args.check:
+        mismatches = check(args.check)
+        for level, penalty, expected in mismatches:
+            print(f"A* {penalty} != Dijkstra {expected}:")
+            print("\n".join("".join(row) for row in level))
+        print(f"{args.check - len(mismatches)}/{args.check} levels agree")
+        raise SystemExit(1 if mismatches else 0)
+    start = time.perf_counter()
+    penalty, actions = solve(LEVEL)
+    print(f"Optimal penalty: {penalty} ({len(actions)} moves, {time.perf_counter() - start:.3f}s)")
+    print(" ".join(actions))
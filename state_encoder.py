@@ -0,0 +1,187 @@
+import random
+from levels import LevelInfo, COLLECTIBLE_TILES
+
+
+# Maps a game state to a single integer: the player's cell index plus a
+# bitmask with one bit per dot, star and ghost that is still on the board.
+#
+#   key = mask * number_of_cells + (y * width + x)
+#
+# The layout of the level (walls, exit, where collectibles started) is fixed
+# per encoder, so the key identifies the state exactly. Because of that the
+# successors of a key can be computed from precomputed per-cell tables,
+# without touching the grid. The collectible cells come from the level's
+# LevelInfo, pass the environment's to avoid scanning the level again.
+class StateEncoder:
+    def __init__(self, level, actions, tile_penalties, terminal_tiles, info=None):
+        info = info if info is not None else LevelInfo(level)
+        self.height = info.height
+        self.width = info.width
+        self.num_cells = self.width * self.height
+        self.collectible_cells = info.collectible_cells
+        # Bit index of the collectible that starts on each cell, None otherwise
+        self.bit_of_cell = [None] * self.num_cells
+        for bit, (x, y) in enumerate(self.collectible_cells):
+            self.bit_of_cell[y * self.width + x] = bit
+        self.action_names = list(actions)
+        self.build_successor_table(level, actions, tile_penalties, terminal_tiles)
+
+    def build_successor_table(self, level, actions, tile_penalties, terminal_tiles):
+        # For every cell and action: None if the move is blocked, otherwise
+        # (target_cell, collectible_bit, reward_if_present, terminal_if_present,
+        #  reward_if_gone, terminal_if_gone)
+        self.successor_table = []
+        for y in range(self.height):
+            for x in range(self.width):
+                moves = []
+                for dx, dy in actions.values():
+                    nx, ny = x + dx, y + dy
+                    if not (0 <= nx < self.width and 0 <= ny < self.height) or level[ny][nx] == 'X':
+                        moves.append(None)
+                        continue
+                    target = ny * self.width + nx
+                    tile = level[ny][nx]
+                    bit = self.bit_of_cell[target]
+                    if bit is None:
+                        # 'P' only marks the start, the cell behaves like an empty one
+                        tile = ' ' if tile == 'P' else tile
+                        reward = tile_penalties.get(tile, 0)
+                        terminal = tile in terminal_tiles
+                        moves.append((target, 0, reward, terminal, reward, terminal))
+                    else:
+                        moves.append((target, 1 << bit,
+                                      tile_penalties.get(tile, 0), tile in terminal_tiles,
+                                      tile_penalties[' '], False))
+                self.successor_table.append(moves)
+
+    @property
+    def key_bits(self):
+        # Bits needed by the largest key, which grows with the collectibles
+        return ((1 << len(self.collectible_cells)) * self.num_cells - 1).bit_length()
+
+    def cell_index(self, pos):
+        x, y = pos
+        return y * self.width + x
+
+    def mask_from_level(self, level):
+        mask = 0
+        for bit, (x, y) in enumerate(self.collectible_cells):
+            if level[y][x] in COLLECTIBLE_TILES:
+                mask |= 1 << bit
+        return mask
+
+    def key(self, pos, mask):
+        return mask * self.num_cells + self.cell_index(pos)
+
+    def encode(self, pos, level):
+        return self.key(pos, self.mask_from_level(level))
+
+    def decode(self, key):
+        mask, cell = divmod(key, self.num_cells)
+        return (cell % self.width, cell // self.width), mask
+
+    def consume(self, mask, pos):
+        # Clears the bit of whatever collectible started on pos
+        bit = self.bit_of_cell[self.cell_index(pos)]
+        if bit is None:
+            return mask
+        return mask & ~(1 << bit)
+
+    def successors(self, key):
+        # (next_key, reward, terminal) for every action, in action_names order.
+        # Blocked moves keep the state and cost 1, like PacManEnv.step.
+        num_cells = self.num_cells
+        mask, cell = divmod(key, num_cells)
+        results = []
+        for move in self.successor_table[cell]:
+            if move is None:
+                results.append((key, 1, False))
+                continue
+            target, bit, reward_present, terminal_present, reward_gone, terminal_gone = move
+            if mask & bit:
+                results.append(((mask ^ bit) * num_cells + target, reward_present, terminal_present))
+            else:
+                results.append((mask * num_cells + target, reward_gone, terminal_gone))
+        return results
+
+
+# Zobrist hashing: every cell gets a random 64-bit key for "player stands
+# here" and every collectible one for "still on the board". The state key is
+# the XOR of the keys that apply:
+#
+#   key = player_keys[cell] ^ collectible_keys[bit] for every remaining bit
+#
+# Unlike the exact key above it stays 64 bits on any map, and a move only
+# changes it by XOR-ing one or two precomputed values, so stepping and
+# successor generation cost the same on a 256x256 maze as on LEVEL. The
+# price is that a key cannot be decoded, so the environment tracks which
+# collectibles are left (`present`, one byte per bit) next to it.
+class ZobristEncoder(StateEncoder):
+    def __init__(self, level, actions, tile_penalties, terminal_tiles, info=None, seed=0):
+        super().__init__(level, actions, tile_penalties, terminal_tiles, info)
+        # Fixed seed so the same level always hashes the same way and saved
+        # value tables stay valid
+        rng = random.Random(seed)
+        self.player_keys = [rng.getrandbits(64) for _ in range(self.num_cells)]
+        self.collectible_keys = [rng.getrandbits(64) for _ in self.collectible_cells]
+        self.build_hash_table()
+
+    @property
+    def key_bits(self):
+        return 64
+
+    def build_hash_table(self):
+        # successor_table with the collectible mask replaced by the bit index
+        # (-1 for none) and the XOR delta of moving the player
+        self.hash_table = []
+        for cell, moves in enumerate(self.successor_table):
+            hash_moves = []
+            for move in moves:
+                if move is None:
+                    hash_moves.append(None)
+                    continue
+                target, bit_mask, reward_present, terminal_present, reward_gone, terminal_gone = move
+                bit = bit_mask.bit_length() - 1
+                delta = self.player_keys[cell] ^ self.player_keys[target]
+                hash_moves.append((delta, bit, reward_present, terminal_present, reward_gone, terminal_gone))
+            self.hash_table.append(hash_moves)
+
+    def initial_present(self, level):
+        return bytearray(level[y][x] in COLLECTIBLE_TILES for x, y in self.collectible_cells)
+
+    def hash(self, pos, present):
+        # Full recomputation, the environment normally updates keys with move
+        key = self.player_keys[self.cell_index(pos)]
+        for bit, collectible_key in enumerate(self.collectible_keys):
+            if present[bit]:
+                key ^= collectible_key
+        return key
+
+    def encode(self, pos, level):
+        return self.hash(pos, self.initial_present(level))
+
+    def move(self, key, present, pos, target_pos):
+        # Key after the player moves from pos to target_pos; clears the
+        # collectible on target_pos in present
+        target = self.cell_index(target_pos)
+        key ^= self.player_keys[self.cell_index(pos)] ^ self.player_keys[target]
+        bit = self.bit_of_cell[target]
+        if bit is not None and present[bit]:
+            present[bit] = 0
+            key ^= self.collectible_keys[bit]
+        return key
+
+    def hash_successors(self, key, pos, present):
+        # Same as StateEncoder.successors for a Zobrist key
+        collectible_keys = self.collectible_keys
+        results = []
+        for move in self.hash_table[self.cell_index(pos)]:
+            if move is None:
+                results.append((key, 1, False))
+                continue
+            delta, bit, reward_present, terminal_present, reward_gone, terminal_gone = move
+            if bit >= 0 and present[bit]:
+                results.append((key ^ delta ^ collectible_keys[bit], reward_present, terminal_present))
+            else:
+                results.append((key ^ delta, reward_gone, terminal_gone))
+        return results
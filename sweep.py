@@ -0,0 +1,109 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import random
+import time
+from pacman_env import LEVEL
+from td_agent import TDAgent
+from levels import add_level_arguments, level_from_args
+from train import train, DEFAULT_MAX_STEPS
+
+# Hyperparameter sweep over (learning_rate, discount_factor, exploration_rate).
+# Every configuration is trained headless in its own worker process with its
+# own seed, and results are appended to a JSONL file as runs finish.
+
+DEFAULT_LEARNING_RATES = [0.01, 0.05, 0.1, 0.2]
+DEFAULT_DISCOUNT_FACTORS = [0.9, 0.99, 1]
+DEFAULT_EXPLORATION_RATES = [0.01, 0.05, 0.1]
+
+
+def grid_configs(learning_rates, discount_factors, exploration_rates):
+    return list(itertools.product(learning_rates, discount_factors, exploration_rates))
+
+
+def random_configs(samples, learning_rate_range, discount_factor_range, exploration_rate_range, seed=None):
+    rng = random.Random(seed)
+    return [(rng.uniform(*learning_rate_range),
+             rng.uniform(*discount_factor_range),
+             rng.uniform(*exploration_rate_range)) for _ in range(samples)]
+
+
+def run_config(job):
+    (learning_rate, discount_factor, exploration_rate), episodes, seed, final_window, max_steps, level = job
+    random.seed(seed)
+    agent = TDAgent(learning_rate, discount_factor, exploration_rate)
+    start = time.perf_counter()
+    penalties = train(agent, episodes, level, max_steps)
+    wall_time = time.perf_counter() - start
+    final = penalties[-final_window:]
+    return {
+        "learning_rate": learning_rate,
+        "discount_factor": discount_factor,
+        "exploration_rate": exploration_rate,
+        "seed": seed,
+        "episodes": episodes,
+        "final_avg_penalty": sum(final) / len(final),
+        "best_penalty": min(penalties),
+        "wall_time": wall_time,
+    }
+
+
+def sweep(configs, episodes, output_path, seed=0, final_window=100, processes=None, max_steps=DEFAULT_MAX_STEPS,
+          level=LEVEL):
+    jobs = [(config, episodes, seed + i, final_window, max_steps, level) for i, config in enumerate(configs)]
+    results = []
+    with multiprocessing.Pool(processes) as pool, open(output_path, "a") as output:
+        for result in pool.imap_unordered(run_config, jobs):
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            results.append(result)
+            print(f"lr={result['learning_rate']:.4g} gamma={result['discount_factor']:.4g} "
+                  f"eps={result['exploration_rate']:.4g} | final avg: {result['final_avg_penalty']:.2f} | "
+                  f"best: {result['best_penalty']} | {result['wall_time']:.2f}s")
+    return results
+
+
+def float_list(text):
+    return [float(value) for value in text.split(",")]
+
+
+def float_range(text):
+    low, high = float_list(text)
+    return low, high
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep TDAgent hyperparameters across all cores.")
+    parser.add_argument("--episodes", type=int, default=2000)
+    parser.add_argument("--output", default="sweep_results.jsonl")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first run, run i uses seed + i")
+    parser.add_argument("--processes", type=int, default=None, help="defaults to the number of cores")
+    parser.add_argument("--final-window", type=int, default=100,
+                        help="number of last episodes averaged for the final penalty")
+    parser.add_argument("--max-steps", type=int, default=DEFAULT_MAX_STEPS)
+    parser.add_argument("--learning-rates", type=float_list, default=DEFAULT_LEARNING_RATES)
+    parser.add_argument("--discount-factors", type=float_list, default=DEFAULT_DISCOUNT_FACTORS)
+    parser.add_argument("--exploration-rates", type=float_list, default=DEFAULT_EXPLORATION_RATES)
+    parser.add_argument("--random", type=int, default=None, metavar="N",
+                        help="sample N random configurations from the ranges of the given values instead of a grid")
+    add_level_arguments(parser)
+    args = parser.parse_args()
+    level = level_from_args(args, LEVEL)
+
+    if args.random is not None:
+        configs = random_configs(args.random,
+                                 (min(args.learning_rates), max(args.learning_rates)),
+                                 (min(args.discount_factors), max(args.discount_factors)),
+                                 (min(args.exploration_rates), max(args.exploration_rates)),
+                                 args.seed)
+    else:
+        configs = grid_configs(args.learning_rates, args.discount_factors, args.exploration_rates)
+
+    start = time.perf_counter()
+    results = sweep(configs, args.episodes, args.output, args.seed, args.final_window, args.processes, args.max_steps,
+                    level)
+    best = min(results, key=lambda result: result["final_avg_penalty"])
+    print(f"{len(results)} runs in {time.perf_counter() - start:.2f}s, results appended to {args.output}")
+    print(f"Best: lr={best['learning_rate']:.4g} gamma={best['discount_factor']:.4g} "
+          f"eps={best['exploration_rate']:.4g} | final avg: {best['final_avg_penalty']:.2f}")
@@ -1,95 +1,190 @@
 import random
 from collections import defaultdict
 
+# Eligibility traces below this are dropped, which bounds the number of
+# states touched per update to about log(threshold) / log(γλ)
+TRACE_THRESHOLD = 0.01
+
+
 class TDAgent:
-    def __init__(self, learning_rate=0.05, discount_factor=1, exploration_rate=0.05):
+    def __init__(self, learning_rate=0.05, discount_factor=1, exploration_rate=0.05, trace_decay=0.0):
+        # With γλ >= 1 traces never fade below TRACE_THRESHOLD and every update
+        # would touch every state visited so far
+        if trace_decay < 0 or (trace_decay and discount_factor * trace_decay >= 1):
+            raise ValueError("trace_decay must be >= 0 and discount_factor * trace_decay below 1")
         self.V = defaultdict(float)  # State-value function: maps state → estimated value
         self.learning_rate = learning_rate  # α in TD update
         self.discount_factor = discount_factor  # γ: future reward discounting
         self.exploration_rate = exploration_rate  # ε: chance to explore randomly
+        self.trace_decay = trace_decay  # λ: 0 is plain TD(0), otherwise TD(λ)
+        self.traces = {}  # Eligibility of recently visited states (TD(λ) only)
+        self.episode_actions = []  # Action names chosen in the current episode
+        self.last_actions = []  # Action names of the previous episode
+        self.best_penalty = None
+        self.best_actions = []  # Action names of the best episode so far
+        self.greedy_cache = None  # (level id, watched (key, value) pairs, path)
+        self.rollout_env = None
 
     def get_state(self, game):
-        # Extracts a hashable representation of the game state
-        pos = game.player_pos
-        level = game.level
-        tiles = tuple(tuple(row) for row in level)
-        return (pos, tiles)
-
-    def get_state_from_level(self, pos, level):
-        # Used to create a new state tuple after simulating a move
-        tiles = tuple(tuple(row) for row in level)
-        return (pos, tiles)
+        # Compact integer key (player position + remaining collectibles),
+        # maintained incrementally by the environment
+        return game.state_key
 
     def simulate_adjacent_states(self, game):
-        x, y = game.player_pos
-        directions = {
-            'left': (-1, 0),
-            'right': (1, 0),
-            'up': (0, -1),
-            'down': (0, 1)
-        }
-        results = {}
-        for dir, (dx, dy) in directions.items():
-            nx, ny = x + dx, y + dy
-            
-            if not game.can_move(nx, ny):
-                results[dir] = (self.get_state_from_level((x, y), game.level), 1, False)
-                continue
-            
-            # Create a deep copy of the level to simulate the move
-            new_level = [row[:] for row in game.level]
-            tile = new_level[ny][nx]
-
-            # Assign immediate reward based on the tile type
-            reward = {
-                'G': 100,   # Ghost: high penalty
-                'E': 0,     # Exit/goal: neutral
-                '*': -10,   # Collectible/star: good
-                '.': -1,    # Minor reward
-                ' ': 1      # Empty space: small cost
-            }.get(tile, 0)
-
-            # Update player position in the simulated level
-            new_level[y][x] = ' '
-            new_level[ny][nx] = 'P'
-            new_state = self.get_state_from_level((nx, ny), new_level)
-            terminal = tile in {'G', 'E'}
-
-            results[dir] = (new_state, reward, terminal)
-
-        return results
+        # (action name, (next_key, reward, terminal)) pairs, read once. The
+        # successors come from the encoder's precomputed per-level tables,
+        # so no copy of the level is made
+        return zip(game.encoder.action_names, game.successors())
 
     def choose_action(self, game, actions_by_name):
         if random.random() < self.exploration_rate:
             # Explore: choose a random legal action
-            return random.choice(list(actions_by_name.values()))
+            chosen = random.choice(list(actions_by_name))
+        else:
+            # Exploit: evaluate all adjacent states
+            best_dirs = self.best_directions(self.simulate_adjacent_states(game), self.V.__getitem__)
+            # Break ties randomly
+            chosen = random.choice(best_dirs) if best_dirs else random.choice(list(actions_by_name))
+        self.episode_actions.append(chosen)
+        return actions_by_name[chosen]
 
-        # Exploit: evaluate all adjacent states
-        state_sim = self.simulate_adjacent_states(game)
-        best_value = float('inf') 
+    def best_directions(self, state_sim, value_of):
+        best_value = float('inf')
         best_dirs = []
 
-        for direction, (next_state, reward, terminal) in state_sim.items():
+        for direction, (next_state, reward, terminal) in state_sim:
             v = reward
             if not terminal:
-                v += self.discount_factor * self.V[next_state]
+                v += self.discount_factor * value_of(next_state)
 
             if v < best_value:
                 best_value = v
                 best_dirs = [direction]
             elif v == best_value:
                 best_dirs.append(direction)
-
-        if best_dirs:
-            # Break ties randomly
-            chosen = random.choice(best_dirs)
-            return actions_by_name[chosen]
-        else:
-            return random.choice(list(actions_by_name.values()))
+        return best_dirs
 
     def update(self, old_state, reward, new_state):
+        if self.trace_decay:
+            self.update_traces(old_state, reward, new_state)
+            return
         # TD(0) update rule
         old_v = self.V[old_state]
         self.V[old_state] += self.learning_rate * (
             reward + self.discount_factor * self.V[new_state] - old_v
         )
+
+    def update_traces(self, old_state, reward, new_state):
+        # TD(λ) with replacing traces: the TD error of this step is applied to
+        # every recently visited state, weighted by how long ago it was visited
+        V = self.V
+        error = reward + self.discount_factor * V[new_state] - V[old_state]
+        traces = self.traces
+        traces[old_state] = 1.0
+        step = self.learning_rate * error
+        decay = self.discount_factor * self.trace_decay
+        faded = []
+        for state, trace in traces.items():
+            V[state] += step * trace
+            trace *= decay
+            if trace < TRACE_THRESHOLD:
+                faded.append(state)
+            else:
+                traces[state] = trace
+        for state in faded:
+            del traces[state]
+
+    def end_episode(self, penalty=None):
+        # Traces must not carry over into the next episode. With the final
+        # penalty the episode's actions are kept if it is the best so far.
+        self.traces.clear()
+        if penalty is not None and (self.best_penalty is None or penalty < self.best_penalty):
+            self.best_penalty = penalty
+            self.best_actions = self.episode_actions
+        self.last_actions = self.episode_actions
+        self.episode_actions = []
+
+    def greedy_path(self, env, max_steps=1000):
+        # Rolls out the greedy policy (no exploration, ties broken by action
+        # order) from the start of env's level on a scratch environment. The
+        # result only depends on the values of the successors looked at along
+        # the way, so it is cached until one of those entries changes.
+        # Returns (actions, positions, penalty, finished): the action names,
+        # the cells visited starting with the start cell, the penalty and
+        # whether the rollout reached a terminal tile.
+        from pacman_env import level_id
+        layout_id = level_id(env.initial_level, env.hashing)
+        if self.greedy_cache is not None:
+            cached_id, watched, path = self.greedy_cache
+            if cached_id == layout_id and all(self.V.get(key, 0.0) == value for key, value in watched):
+                return path
+
+        rollout = self.rollout_env
+        if rollout is None or rollout.initial_level != env.initial_level or rollout.hashing != env.hashing:
+            from pacman_env import PacManEnv
+            rollout = self.rollout_env = PacManEnv(env.initial_level, env.hashing)
+        rollout.reset()
+        # Unknown states are read with get so the rollout does not grow V
+        values = {}
+
+        def value_of(key):
+            value = values[key] = self.V.get(key, 0.0)
+            return value
+
+        actions = []
+        positions = [rollout.player_pos]
+        seen = {rollout.state_key}
+        while rollout.running and len(actions) < max_steps:
+            best_dirs = self.best_directions(self.simulate_adjacent_states(rollout), value_of)
+            rollout.step(best_dirs[0])
+            actions.append(best_dirs[0])
+            positions.append(rollout.player_pos)
+            if rollout.state_key in seen:
+                # The greedy policy loops, it would never finish
+                break
+            seen.add(rollout.state_key)
+        path = (actions, positions, rollout.penalty, not rollout.running)
+        self.greedy_cache = (layout_id, list(values.items()), path)
+        return path
+
+    def save(self, path, level_id=0):
+        from value_store import save_value_table
+        save_value_table(self.V, path, level_id)
+
+    def load(self, path, level_id=None, mmap=False):
+        # mmap=True shares the file read-only (for evaluation), otherwise the
+        # table is loaded into memory so training can continue
+        from value_store import load_value_table, MappedValueTable
+        if mmap:
+            self.V = MappedValueTable(path, level_id)
+        else:
+            self.V = load_value_table(path, level_id)
+
+    # Batched path for BatchPacManEnv: actions are indices into ACTIONS and
+    # states are arrays of compact keys, one per lane.
+    def choose_actions(self, batch_env):
+        import numpy as np
+        next_keys, rewards, terminal = batch_env.successors()
+        V = self.V
+        future = np.fromiter((V[key] for key in next_keys.ravel().tolist()),
+                             dtype=np.float64, count=next_keys.size).reshape(next_keys.shape)
+        values = rewards + np.where(terminal, 0.0, self.discount_factor * future)
+
+        # Break ties randomly, like choose_action
+        best = values == values.min(axis=1, keepdims=True)
+        actions = np.argmax(best * batch_env.rng.random(values.shape), axis=1)
+
+        explore = batch_env.rng.random(batch_env.num_envs) < self.exploration_rate
+        actions[explore] = batch_env.rng.integers(0, values.shape[1], explore.sum())
+        return actions
+
+    def update_batch(self, old_states, rewards, new_states, active):
+        # TD(0) update for every lane that was still running before the step.
+        # Applied sequentially so lanes sharing a state see each other's updates.
+        if self.trace_decay:
+            # One traces dict would mix the TD errors of unrelated episodes
+            raise ValueError("batched updates only support TD(0), trace_decay must be 0")
+        for old_state, reward, new_state in zip(old_states[active].tolist(),
+                                                rewards[active].tolist(),
+                                                new_states[active].tolist()):
+            self.update(old_state, reward, new_state)
@@ -0,0 +1,162 @@
+import os
+import struct
+import numpy as np
+from pacman_env import ACTIONS
+
+# Binary episode trace log, appended to while training:
+#
+#   header  magic b"PMTR", version (uint32), level id (uint32), seed (int64,
+#           -1 if the run was not seeded)
+#   records one per episode:
+#           episode number (uint32), penalty (int32), number of steps (uint32),
+#           actions packed 2 bits each, four per byte, in ACTIONS order
+#
+# Rewards are not stored: the level and the actions determine them, and
+# replaying an episode reproduces every reward and the final penalty. An
+# episode of 40 steps takes 22 bytes; on LEVEL, where early episodes are
+# longer, a million episodes take about 24 MB.
+MAGIC = b"PMTR"
+VERSION = 1
+HEADER = struct.Struct("<4sIIq")
+RECORD = struct.Struct("<IiI")
+
+ACTION_NAMES = list(ACTIONS)
+ACTION_INDEX = {name: i for i, name in enumerate(ACTION_NAMES)}
+
+# The viewer keeps a snapshot of the environment every this many steps, so
+# seeking replays at most this many steps
+KEYFRAME_INTERVAL = 32
+
+
+def pack_actions(actions):
+    indices = np.fromiter((ACTION_INDEX[action] for action in actions), dtype=np.uint8, count=len(actions))
+    padded = np.zeros(-(-len(indices) // 4) * 4, dtype=np.uint8)
+    padded[:len(indices)] = indices
+    quads = padded.reshape(-1, 4)
+    return (quads[:, 0] | quads[:, 1] << 2 | quads[:, 2] << 4 | quads[:, 3] << 6).tobytes()
+
+
+def unpack_actions(data, steps):
+    packed = np.frombuffer(data, dtype=np.uint8)
+    indices = np.stack([packed & 3, packed >> 2 & 3, packed >> 4 & 3, packed >> 6 & 3], axis=1).ravel()[:steps]
+    return [ACTION_NAMES[i] for i in indices.tolist()]
+
+
+# Appends one record per finished episode. Writes go through the file
+# object's buffer; close() (or flush()) makes them visible to readers.
+class TraceWriter:
+    def __init__(self, path, level_id, seed=None):
+        self.path = path
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            # Continue an existing log, which must belong to the same level
+            # and seed, because the header holds the seed of every record
+            existing = TraceFile(path, level_id)
+            if existing.seed != seed:
+                raise ValueError(f"{path} was recorded with seed {existing.seed}, not {seed}; "
+                                 "use a new trace file")
+            self.episode = len(existing)
+            self.file = open(path, "ab")
+        else:
+            self.file = open(path, "wb")
+            self.file.write(HEADER.pack(MAGIC, VERSION, level_id, -1 if seed is None else seed))
+            self.episode = 0
+
+    def write(self, actions, penalty):
+        self.episode += 1
+        self.file.write(RECORD.pack(self.episode, penalty, len(actions)))
+        self.file.write(pack_actions(actions))
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_header(path, level_id=None):
+    with open(path, "rb") as f:
+        magic, version, stored_level_id, seed = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a trace file")
+    if level_id is not None and stored_level_id != level_id:
+        raise ValueError(f"{path} was recorded on a different level")
+    return stored_level_id, (None if seed < 0 else seed)
+
+
+# Random access to the episodes of a trace file. Opening it only scans the
+# record headers to find each episode's offset; actions are read on demand.
+class TraceFile:
+    def __init__(self, path, level_id=None):
+        self.path = path
+        self.level_id, self.seed = read_header(path, level_id)
+        self.offsets = []
+        self.penalties = []
+        self.steps = []
+        file_size = os.path.getsize(path)
+        with open(path, "rb") as f:
+            f.seek(HEADER.size)
+            while True:
+                offset = f.tell()
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    break
+                _, penalty, steps = RECORD.unpack(header)
+                size = -(-steps // 4)
+                f.seek(size, os.SEEK_CUR)
+                if f.tell() > file_size:
+                    # A record that was still being written
+                    break
+                self.offsets.append(offset)
+                self.penalties.append(penalty)
+                self.steps.append(steps)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def actions(self, index):
+        with open(self.path, "rb") as f:
+            f.seek(self.offsets[index] + RECORD.size)
+            return unpack_actions(f.read(-(-self.steps[index] // 4)), self.steps[index])
+
+    def best_index(self):
+        return min(range(len(self.penalties)), key=self.penalties.__getitem__)
+
+
+# Replays one recorded episode on an environment and moves to any step of
+# it, forwards or backwards, by restoring the nearest keyframe at or before
+# that step and replaying the remaining actions. The agent is not involved.
+class TraceReplay:
+    def __init__(self, env, actions):
+        self.env = env
+        self.actions = actions
+        # keyframes[i] is the state after i * KEYFRAME_INTERVAL steps
+        env.reset()
+        self.keyframes = [self.snapshot()]
+        self.rewards = []
+        for step, action in enumerate(actions, 1):
+            reward, _, _ = env.step(action)
+            self.rewards.append(reward)
+            if step % KEYFRAME_INTERVAL == 0:
+                self.keyframes.append(self.snapshot())
+        self.step = len(actions)
+
+    def snapshot(self):
+        env = self.env
+        return ([row[:] for row in env.level], env.player_pos, env.penalty, env.running,
+                env.collectible_mask, env.present[:] if env.present is not None else None, env.state_key)
+
+    def restore(self, keyframe):
+        env = self.env
+        level, env.player_pos, env.penalty, env.running, env.collectible_mask, present, env.state_key = keyframe
+        env.level = [row[:] for row in level]
+        env.present = present[:] if present is not None else None
+
+    def seek(self, step):
+        step = max(0, min(step, len(self.actions)))
+        if step < self.step or step // KEYFRAME_INTERVAL != self.step // KEYFRAME_INTERVAL:
+            self.restore(self.keyframes[step // KEYFRAME_INTERVAL])
+            self.step = step // KEYFRAME_INTERVAL * KEYFRAME_INTERVAL
+        while self.step < step:
+            self.env.step(self.actions[self.step])
+            self.step += 1
+        return self.step
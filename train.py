@@ -0,0 +1,199 @@
+import argparse
+import random
+import time
+from pacman_env import PacManEnv, ACTIONS, LEVEL, HASHING_MODES, level_id
+from td_agent import TDAgent
+from levels import add_level_arguments, level_from_args
+
+# Headless training: the agent picks action names which are applied directly
+# to the environment, nothing is drawn and there is no frame rate cap.
+ACTION_NAMES = {name: name for name in ACTIONS}
+
+# Safety net against episodes that never reach a terminal tile
+DEFAULT_MAX_STEPS = 10000
+
+
+def run_episode(env, agent, max_steps=DEFAULT_MAX_STEPS):
+    env.reset()
+    steps = 0
+    while env.running and steps < max_steps:
+        old_state = agent.get_state(env)
+        action = agent.choose_action(env, ACTION_NAMES)
+        reward, _, _ = env.step(action)
+        new_state = agent.get_state(env)
+        agent.update(old_state, reward, new_state)
+        steps += 1
+    agent.end_episode(env.penalty)
+    return env.penalty, steps
+
+
+def train(agent, episodes, level=LEVEL, max_steps=DEFAULT_MAX_STEPS, hashing="exact"):
+    env = PacManEnv(level, hashing)
+    penalties = []
+    for _ in range(episodes):
+        penalty, _ = run_episode(env, agent, max_steps)
+        penalties.append(penalty)
+    return penalties
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the TD(0) agent without a UI.")
+    parser.add_argument("--episodes", type=int, default=1000)
+    parser.add_argument("--learning-rate", type=float, default=0.05)
+    parser.add_argument("--discount-factor", type=float, default=1)
+    parser.add_argument("--exploration-rate", type=float, default=0.05)
+    parser.add_argument("--trace-decay", type=float, default=0.0, metavar="LAMBDA",
+                        help="use TD(lambda) with this trace decay instead of TD(0)")
+    parser.add_argument("--max-steps", type=int, default=DEFAULT_MAX_STEPS)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--optimal", action="store_true",
+                        help="solve the level exactly first, report regret and stop once an episode is optimal")
+    parser.add_argument("--resume", default=None, help="value table file to continue training from")
+    parser.add_argument("--checkpoint", default=None, help="value table file to save to while training")
+    parser.add_argument("--checkpoint-every", type=int, default=1000, help="episodes between checkpoints")
+    parser.add_argument("--trace", default=None, help="append the actions of every episode to this trace file")
+    parser.add_argument("--metrics", default=None, help="stream per-episode metrics to this .csv or .jsonl file")
+    parser.add_argument("--phase-timers", action="store_true",
+                        help="count calls and time of the hot-path phases and print them with the progress")
+    parser.add_argument("--cprofile", default=None, metavar="FILE",
+                        help="run the training under cProfile and save the stats to this file")
+    parser.add_argument("--num-envs", type=int, default=1,
+                        help="step this many games at once with the NumPy batch environment")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="train one shared value table with this many processes")
+    parser.add_argument("--hashing", choices=HASHING_MODES, default="exact",
+                        help="state keys: exact encoding or 64-bit Zobrist hashes (for large mazes)")
+    parser.add_argument("--check-keys", action="store_true",
+                        help="recompute the state key from the grid after every step (slow, for debugging)")
+    parser.add_argument("--max-states", type=int, default=None,
+                        help="cap the value table at this many states and evict the rest")
+    parser.add_argument("--memory-budget", type=float, default=None, metavar="MB",
+                        help="cap the value table at roughly this much memory")
+    parser.add_argument("--eviction", choices=("lru", "lfu"), default="lru",
+                        help="which states a capped value table evicts first")
+    parser.add_argument("--linear", action="store_true",
+                        help="approximate values from state features instead of keeping a table")
+    add_level_arguments(parser)
+    args = parser.parse_args()
+    level = level_from_args(args, LEVEL)
+    if args.num_envs > 1 and args.hashing != "exact":
+        parser.error("--num-envs only supports --hashing exact")
+    if args.num_envs > 1 and (args.trace or args.metrics):
+        parser.error("--trace and --metrics are not supported with --num-envs")
+    if args.num_envs > 1 and args.trace_decay:
+        parser.error("--num-envs only supports TD(0), traces would mix the lanes")
+    if args.workers > 1 and (args.num_envs > 1 or args.trace or args.metrics or args.linear
+                             or args.max_states is not None or args.memory_budget is not None):
+        parser.error("--workers cannot be combined with --num-envs, --trace, --metrics, --linear or a capped table")
+    if args.linear and (args.hashing != "exact" or args.resume or args.checkpoint):
+        parser.error("--linear needs --hashing exact and cannot be combined with --resume or --checkpoint")
+    if args.checkpoint:
+        from value_store import KEY_BITS
+        key_bits = PacManEnv(level, args.hashing).encoder.key_bits
+        if key_bits > KEY_BITS:
+            parser.error(f"state keys of this level need {key_bits} bits and cannot be checkpointed "
+                         f"(the file format holds {KEY_BITS}), use --hashing zobrist")
+
+    if args.trace_decay < 0 or args.discount_factor * args.trace_decay >= 1:
+        parser.error("--trace-decay must be >= 0 and --discount-factor * --trace-decay below 1")
+
+    if args.seed is not None:
+        random.seed(args.seed)
+    agent = TDAgent(args.learning_rate, args.discount_factor, args.exploration_rate, args.trace_decay)
+    if args.resume:
+        agent.load(args.resume, level_id(level, args.hashing))
+        print(f"Resumed {len(agent.V)} states from {args.resume}")
+    if args.max_states is not None or args.memory_budget is not None:
+        from value_store import BoundedValueTable, capacity_for_budget
+        capacity = args.max_states or capacity_for_budget(args.memory_budget * 1024 * 1024,
+                                                          PacManEnv(level, args.hashing).encoder.key_bits)
+        agent.V = BoundedValueTable(capacity, args.eviction, agent.V.items())
+    if args.linear:
+        from linear_value import LinearValueFunction
+        agent.V = LinearValueFunction(PacManEnv(level))
+    checkpointer = None
+    if args.checkpoint:
+        from value_store import Checkpointer
+        checkpointer = Checkpointer(agent, args.checkpoint, args.checkpoint_every, level_id(level, args.hashing))
+    trace_writer = None
+    if args.trace:
+        from traces import TraceWriter
+        try:
+            trace_writer = TraceWriter(args.trace, level_id(level), args.seed)
+        except ValueError as error:
+            parser.error(str(error))
+    metrics_writer = None
+    if args.metrics:
+        from metrics import MetricsWriter
+        metrics_writer = MetricsWriter(args.metrics)
+    optimal = None
+    if args.optimal:
+        from solver import solve
+        optimal, _ = solve(level)
+        print(f"Optimal penalty: {optimal}")
+    if args.phase_timers:
+        import profiling
+        profiling.register_agent_phases()
+        profiling.enable()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.workers > 1:
+        from shared_train import train_shared
+        penalties, steps, elapsed, agent.V = train_shared(
+            args.episodes, args.workers, level, args.hashing, args.seed or 0,
+            (args.learning_rate, args.discount_factor, args.exploration_rate, args.trace_decay),
+            args.max_steps, initial=agent.V)
+        print(f"{len(penalties)} episodes on {args.workers} workers in {elapsed:.2f}s | {steps / elapsed:.0f} steps/sec | "
+              f"Best score: {min(penalties)} | "
+              f"Average for last 100 rounds: {sum(penalties[-100:]) / len(penalties[-100:]):.2f}")
+        if optimal is not None:
+            print(f"Regret: {min(penalties) - optimal}")
+    elif args.num_envs > 1:
+        from batch_env import train_batch
+        start = time.perf_counter()
+        penalties = train_batch(agent, args.episodes, args.num_envs, level, args.max_steps, args.seed)
+        elapsed = time.perf_counter() - start
+        print(f"{len(penalties)} episodes in {elapsed:.2f}s | Best score: {min(penalties)} | "
+              f"Average for last 100 rounds: {sum(penalties[-100:]) / len(penalties[-100:]):.2f}")
+        if optimal is not None:
+            print(f"Regret: {min(penalties) - optimal}")
+    else:
+        env = PacManEnv(level, args.hashing, args.check_keys)
+        start = time.perf_counter()
+        total_steps = 0
+        best = None
+        for episode in range(1, args.episodes + 1):
+            penalty, steps = run_episode(env, agent, args.max_steps)
+            total_steps += steps
+            if trace_writer is not None:
+                trace_writer.write(agent.last_actions, penalty)
+            if metrics_writer is not None:
+                metrics_writer.write(episode, penalty, steps, len(agent.V))
+            if best is None or penalty < best:
+                best = penalty
+            if checkpointer is not None:
+                checkpointer.maybe_save(episode)
+            reached_optimal = optimal is not None and penalty <= optimal
+            if episode % 100 == 0 or episode == args.episodes or reached_optimal:
+                elapsed = time.perf_counter() - start
+                regret = f" | Regret: {best - optimal}" if optimal is not None else ""
+                print(f"Episode {episode} | Penalty: {penalty} | Best score: {best}{regret} | {total_steps / elapsed:.0f} steps/sec")
+                if args.phase_timers:
+                    print(profiling.report())
+            if reached_optimal:
+                print(f"Reached the optimal penalty after {episode} episodes")
+                break
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.cprofile)
+        print(f"Saved cProfile stats to {args.cprofile}")
+    if trace_writer is not None:
+        trace_writer.close()
+    if metrics_writer is not None:
+        metrics_writer.close()
+    if checkpointer is not None:
+        checkpointer.close()
+        print(f"Saved {len(agent.V)} states to {args.checkpoint}")
@@ -0,0 +1,338 @@
+import heapq
+import os
+import struct
+import threading
+from collections import defaultdict, OrderedDict
+import numpy as np
+
+# Binary value table file:
+#
+#   header  magic b"PMVT", version (uint32), level id (uint32), padding (uint32),
+#           number of entries (uint64)
+#   keys    uint64[count], sorted ascending
+#   values  float32[count]
+#
+# Keys are the compact state keys from StateEncoder. They only have a meaning
+# for one level, so the level id is stored alongside and checked on load.
+MAGIC = b"PMVT"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIQ")
+KEY_BITS = 64
+
+
+def snapshot(V):
+    # Copies a value table into sorted key/value arrays
+    count = len(V)
+    try:
+        keys = np.fromiter(V.keys(), dtype=np.uint64, count=count)
+    except OverflowError:
+        raise ValueError("state keys do not fit into 64 bits, the level has too many collectibles")
+    values = np.fromiter(V.values(), dtype=np.float32, count=count)
+    order = np.argsort(keys)
+    return keys[order], values[order]
+
+
+def write_value_table(path, keys, values, level_id=0):
+    # Written to a temporary file first so readers never see a partial table
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, level_id, 0, len(keys)))
+        f.write(keys.astype("<u8").tobytes())
+        f.write(values.astype("<f4").tobytes())
+    os.replace(temp_path, path)
+
+
+def save_value_table(V, path, level_id=0):
+    keys, values = snapshot(V)
+    write_value_table(path, keys, values, level_id)
+
+
+def read_header(path, level_id=None):
+    with open(path, "rb") as f:
+        magic, version, stored_level_id, _, count = HEADER.unpack(f.read(HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a value table file")
+    if level_id is not None and stored_level_id != level_id:
+        raise ValueError(f"{path} was saved for a different level")
+    return count
+
+
+def map_arrays(path, level_id=None):
+    count = read_header(path, level_id)
+    if count == 0:
+        return np.zeros(0, dtype="<u8"), np.zeros(0, dtype="<f4")
+    keys = np.memmap(path, dtype="<u8", mode="r", offset=HEADER.size, shape=(count,))
+    values = np.memmap(path, dtype="<f4", mode="r", offset=HEADER.size + 8 * count, shape=(count,))
+    return keys, values
+
+
+def load_value_table(path, level_id=None):
+    # Loads a table into a regular defaultdict, e.g. to resume training
+    keys, values = map_arrays(path, level_id)
+    return defaultdict(float, zip(keys.tolist(), values.tolist()))
+
+
+# Read-only, memory-mapped view of a saved value table. Lookups are a binary
+# search over the mapped keys; the pages are shared through the OS page cache,
+# so any number of evaluation processes can use one file without private copies.
+class MappedValueTable:
+    def __init__(self, path, level_id=None):
+        self.path = path
+        self.keys, self.values = map_arrays(path, level_id)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def index(self, key):
+        if key < 0 or key >= 1 << 64:
+            return None
+        i = int(np.searchsorted(self.keys, np.uint64(key)))
+        if i < len(self.keys) and int(self.keys[i]) == key:
+            return i
+        return None
+
+    def __contains__(self, key):
+        return self.index(key) is not None
+
+    def __getitem__(self, key):
+        # Unknown states are worth 0, like the agent's defaultdict
+        i = self.index(key)
+        return 0.0 if i is None else float(self.values[i])
+
+    def get(self, key, default=None):
+        i = self.index(key)
+        return default if i is None else float(self.values[i])
+
+    def __setitem__(self, key, value):
+        raise TypeError("MappedValueTable is read-only, load it with load_value_table to keep training")
+
+    def items(self):
+        return zip(self.keys.tolist(), self.values.tolist())
+
+
+# Rough memory per entry of a BoundedValueTable without the key (dict slot,
+# float value and the eviction bookkeeping), used to turn a memory budget into
+# a number of entries. Exact keys grow with the number of collectibles, so
+# the key's size is added separately from the encoder's largest key.
+BYTES_PER_ENTRY = 184
+
+EVICTION_POLICIES = ("lru", "lfu")
+
+
+def int_bytes(bits):
+    # Size of a CPython int object with this many bits (30-bit digits)
+    return 24 + 4 * max(1, -(-bits // 30))
+
+
+def capacity_for_budget(budget_bytes, key_bits=64):
+    return max(1, int(budget_bytes // (BYTES_PER_ENTRY + int_bytes(key_bits))))
+
+
+# Value table with at most `capacity` entries. When it is full, storing a new
+# state evicts the least recently used one ("lru") or a batch of the least
+# frequently used ones ("lfu"). Unknown states read as 0 without being
+# inserted, so only updates make the table grow.
+class BoundedValueTable:
+    def __init__(self, capacity, policy="lru", items=()):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"unknown eviction policy {policy!r}, expected one of {EVICTION_POLICIES}")
+        self.capacity = capacity
+        self.policy = policy
+        self.table = OrderedDict()
+        self.counts = {}
+        # LFU evicts this many entries at once so the scan is amortised
+        self.lfu_batch = max(1, capacity // 16)
+        self.evictions = 0
+        for key, value in items:
+            self[key] = value
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, key):
+        return key in self.table
+
+    def touch(self, key):
+        if self.policy == "lru":
+            self.table.move_to_end(key)
+        else:
+            self.counts[key] += 1
+
+    def __getitem__(self, key):
+        value = self.table.get(key)
+        if value is None:
+            return 0.0
+        self.touch(key)
+        return value
+
+    def get(self, key, default=None):
+        # Peeks without counting as a use, e.g. for the UI
+        return self.table.get(key, default)
+
+    def __setitem__(self, key, value):
+        if key in self.table:
+            self.table[key] = value
+            self.touch(key)
+            return
+        if len(self.table) >= self.capacity:
+            self.evict()
+        self.table[key] = value
+        if self.policy == "lfu":
+            self.counts[key] = 1
+
+    def evict(self):
+        if self.policy == "lru":
+            self.table.popitem(last=False)
+            self.evictions += 1
+            return
+        for key, _ in heapq.nsmallest(self.lfu_batch, self.counts.items(), key=lambda item: item[1]):
+            del self.table[key]
+            del self.counts[key]
+            self.evictions += 1
+
+    def keys(self):
+        return self.table.keys()
+
+    def values(self):
+        return self.table.values()
+
+    def items(self):
+        return self.table.items()
+
+
+# Open-addressing hash table of state values in shared memory, for several
+# training processes working on one value function. Slots hold key + 1
+# (0 marks an empty slot) and a float64 value. The occupied slots are also
+# listed in insertion order, followed by their count, so reading the table
+# costs time in its number of entries rather than its capacity. Workers read
+# the whole table lock-free and push their accumulated changes in batches with add(); the
+# lock only serialises those batched writes, so it is taken once per merge
+# rather than once per TD update.
+SHARED_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+class SharedValueTable:
+    def __init__(self, capacity, lock, name=None):
+        from multiprocessing import shared_memory
+        if capacity & (capacity - 1):
+            raise ValueError("capacity must be a power of two")
+        self.capacity = capacity
+        self.lock = lock
+        size = capacity * 24 + 8
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.owner = True
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.keys = np.ndarray(capacity, dtype=np.uint64, buffer=self.memory.buf)
+        self.values = np.ndarray(capacity, dtype=np.float64, buffer=self.memory.buf, offset=capacity * 8)
+        self.occupied = np.ndarray(capacity, dtype=np.int64, buffer=self.memory.buf, offset=capacity * 16)
+        self.count = np.ndarray(1, dtype=np.int64, buffer=self.memory.buf, offset=capacity * 24)
+        if self.owner:
+            self.keys[:] = 0
+            self.values[:] = 0
+            self.count[0] = 0
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def home_slots(self, stored):
+        with np.errstate(over="ignore"):
+            hashed = stored * np.uint64(SHARED_HASH_MULTIPLIER)
+        # Top bits of a multiplicative hash, capacity is 2 ** (bit_length - 1)
+        return (hashed >> np.uint64(65 - self.capacity.bit_length())).astype(np.int64)
+
+    def add(self, keys, deltas):
+        # values[key] += delta for every key, inserting missing keys. keys
+        # must be unique within one call.
+        stored = np.asarray(keys, dtype=np.uint64) + np.uint64(1)
+        deltas = np.asarray(deltas, dtype=np.float64)
+        mask = self.capacity - 1
+        with self.lock:
+            slots = self.home_slots(stored)
+            pending = np.arange(len(stored))
+            found = np.empty(len(stored), dtype=np.int64)
+            claimed = []
+            for _ in range(self.capacity):
+                if not len(pending):
+                    break
+                current = self.keys[slots[pending]]
+                hit = current == stored[pending]
+                found[pending[hit]] = slots[pending[hit]]
+                # Several keys may probe the same empty slot; the first one
+                # claims it and the others keep probing
+                empty = np.flatnonzero(current == 0)
+                _, first = np.unique(slots[pending[empty]], return_index=True)
+                claim = pending[empty[first]]
+                self.keys[slots[claim]] = stored[claim]
+                found[claim] = slots[claim]
+                claimed.append(slots[claim])
+                done = np.zeros(len(pending), dtype=bool)
+                done[hit] = True
+                done[empty[first]] = True
+                pending = pending[~done]
+                slots[pending] = (slots[pending] + 1) & mask
+            else:
+                if len(pending):
+                    raise RuntimeError("shared value table is full, increase its capacity")
+            self.values[found] += deltas
+            # New slots are listed before the count is raised, so a reader
+            # never sees a count that covers unlisted slots
+            if claimed:
+                claimed = np.concatenate(claimed)
+                count = int(self.count[0])
+                self.occupied[count:count + len(claimed)] = claimed
+                self.count[0] = count + len(claimed)
+
+    def items(self):
+        # Consistent enough snapshot for training: entries added while this
+        # runs may or may not be included
+        slots = self.occupied[:int(self.count[0])]
+        return self.keys[slots] - np.uint64(1), self.values[slots]
+
+    def __len__(self):
+        return int(self.count[0])
+
+    def close(self):
+        del self.keys, self.values, self.occupied, self.count
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+# Saves the agent's value table every `every` episodes. Only the snapshot into
+# arrays happens on the caller's thread; writing the file happens in a
+# background thread. If the previous write is still running the checkpoint is
+# skipped rather than waiting for it.
+class Checkpointer:
+    def __init__(self, agent, path, every=1000, level_id=0):
+        self.agent = agent
+        self.path = path
+        self.every = every
+        self.level_id = level_id
+        self.thread = None
+
+    def maybe_save(self, episode):
+        if episode % self.every == 0:
+            self.save()
+
+    def save(self):
+        if self.thread is not None and self.thread.is_alive():
+            return False
+        keys, values = snapshot(self.agent.V)
+        self.thread = threading.Thread(target=write_value_table,
+                                       args=(self.path, keys, values, self.level_id), daemon=True)
+        self.thread.start()
+        return True
+
+    def close(self):
+        # Waits for a running write and stores the final table
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+        self.save()
+        self.thread.join()